@@ -0,0 +1,113 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict, namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+# What sessions keep instead of decoded images
+ImageHandle = namedtuple("ImageHandle", ["job_id", "index"])
+
+
+class ArtifactStore:
+    # Generated images live here as encoded bytes, one directory per job:
+    # a full-resolution JPEG (used for the email attachment) and a
+    # display-sized preview (what the UI renders). Previews are also kept in
+    # a bounded in-memory LRU; the directory is trimmed to max_disk_bytes.
+    def __init__(self, root="artifacts", max_disk_bytes=2 * 1024 ** 3, preview_size=(768, 768),
+                 preview_cache_entries=128, full_quality=95, preview_quality=82):
+        self.root = root
+        self.max_disk_bytes = max_disk_bytes
+        self.preview_size = preview_size
+        self.preview_cache_entries = preview_cache_entries
+        self.full_quality = full_quality
+        self.preview_quality = preview_quality
+        self.previews = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, handle, kind):
+        return os.path.join(self.root, handle.job_id, f"{handle.index}.{kind}.jpg")
+
+    @staticmethod
+    def _write(path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _encode(image, quality):
+        buffer = BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+    def put(self, job_id, index, image):
+        handle = ImageHandle(job_id, index)
+        os.makedirs(os.path.join(self.root, job_id), exist_ok=True)
+        self._write(self._path(handle, "full"), self._encode(image, self.full_quality))
+
+        preview = image.copy()
+        preview.thumbnail(self.preview_size, Image.LANCZOS)
+        preview_bytes = self._encode(preview, self.preview_quality)
+        self._write(self._path(handle, "preview"), preview_bytes)
+        self._remember(handle, preview_bytes)
+
+        self.evict(keep=job_id)
+        return handle
+
+    def _remember(self, handle, preview_bytes):
+        with self.lock:
+            self.previews[handle] = preview_bytes
+            self.previews.move_to_end(handle)
+            while len(self.previews) > self.preview_cache_entries:
+                self.previews.popitem(last=False)
+
+    def preview(self, handle):
+        with self.lock:
+            if handle in self.previews:
+                self.previews.move_to_end(handle)
+                return self.previews[handle]
+        with open(self._path(handle, "preview"), "rb") as f:
+            preview_bytes = f.read()
+        self._remember(handle, preview_bytes)
+        return preview_bytes
+
+    def full_image(self, handle):
+        return Image.open(self._path(handle, "full"))
+
+    def exists(self, handle):
+        return os.path.exists(self._path(handle, "full"))
+
+    def delete(self, job_id):
+        with self.lock:
+            for handle in [h for h in self.previews if h.job_id == job_id]:
+                del self.previews[handle]
+        shutil.rmtree(os.path.join(self.root, job_id), ignore_errors=True)
+
+    def evict(self, keep=None):
+        # Drop whole jobs, least recently written first, until under the disk budget
+        jobs = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name == keep:
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                jobs.append((entry.stat().st_mtime, entry.name, size))
+            except FileNotFoundError:
+                # Already removed by an evict running in another thread or process
+                continue
+            total += size
+        if keep is not None:
+            keep_dir = os.path.join(self.root, keep)
+            try:
+                total += sum(f.stat().st_size for f in os.scandir(keep_dir) if f.is_file())
+            except FileNotFoundError:
+                pass
+        for _, job_id, size in sorted(jobs):
+            if total <= self.max_disk_bytes:
+                break
+            self.delete(job_id)
+            total -= size
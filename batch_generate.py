@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+import generation_pipeline
+from generation_jobs import Job
+from metrics import set_span_tags, span
+
+# Generates dream images for a guest list collected before the event: a CSV of
+# (username, dream) rows, with an optional "username,dream" header. Rows run
+# concurrently, up to --concurrency at a time. Images go to one directory per
+# row under --output, and <output>/manifest.json records each row's status,
+# images and Leonardo generation ids. An interrupted run picks up where it
+# stopped, without paying for the same generations twice.
+# Run from the app directory so st.secrets picks up .streamlit/secrets.toml:
+#     python batch_generate.py dreams.csv --output batch_results
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class Manifest:
+    # Status, images and checkpoint per CSV row, rewritten atomically on every change
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)["entries"]
+        except FileNotFoundError:
+            self.entries = {}
+
+    def entry(self, key, username, dream):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["username"] != username or entry["dream"] != dream:
+                # New row, or the CSV changed under this row since the last run
+                entry = self.entries[key] = {
+                    "username": username, "dream": dream, "status": PENDING,
+                    "images": {}, "checkpoint": {}, "error": None, "seconds": None,
+                }
+            return entry
+
+    def update(self, key, **fields):
+        with self.lock:
+            self.entries[key].update(fields)
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": self.entries}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class BatchJob(Job):
+    # Writes images and Leonardo generation ids through to the manifest
+    def __init__(self, manifest, key, username, directory, checkpoint):
+        super().__init__(username)
+        self.manifest = manifest
+        self.key = key
+        self.directory = directory
+        self.checkpoint = dict(checkpoint)
+
+    def add_partial_result(self, index, image):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{index + 1}.jpg")
+        image.convert("RGB").save(path, format="JPEG", quality=95)
+        super().add_partial_result(index, path)
+        self.manifest.update(self.key, images={str(i): p for i, p in sorted(self.partial_results.items())})
+
+    def save_checkpoint(self, key, value):
+        super().save_checkpoint(key, value)
+        self.manifest.update(self.key, checkpoint=dict(self.checkpoint))
+
+    def clear_checkpoint(self, key):
+        super().clear_checkpoint(key)
+        self.manifest.update(self.key, checkpoint=dict(self.checkpoint))
+
+
+def read_rows(path):
+    # utf-8-sig, because spreadsheet exports of Hebrew text usually start with a BOM
+    rows = []
+    first = True
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            if first:
+                first = False
+                if row[0].strip().lower() == "username":
+                    continue
+            if len(row) < 2 or not row[1].strip():
+                print(f"skipped   line {reader.line_num}: expected username,dream")
+                continue
+            rows.append((row[0].strip(), row[1].strip()))
+    return rows
+
+
+async def run_row(manifest, key, username, dream, output_dir, semaphore, strategy):
+    entry = manifest.entry(key, username, dream)
+    # Unknown guests still get prompt-only images, under the name as written
+    profile = generation_pipeline.get_user_directory().get(username)
+    canonical = profile.username if profile is not None else username
+    directory = os.path.join(output_dir, f"{int(key) + 1:03d}-{canonical.replace(os.sep, '_')}")
+
+    async with semaphore:
+        job = BatchJob(manifest, key, canonical, directory, entry["checkpoint"])
+        set_span_tags(job_id=job.id, username=canonical, row=key)
+        start = time.monotonic()
+        try:
+            with span("job"):
+                await generation_pipeline.generate_images_async(canonical, dream, on_image=job.add_partial_result,
+                                                                strategy=strategy, job=job)
+        except Exception as e:
+            # A rerun starts a failed row over with new generations rather than polling the ones that failed
+            manifest.update(key, status=FAILED, checkpoint={}, error=f"{type(e).__name__}: {e}",
+                            seconds=time.monotonic() - start)
+            print(f"failed    {key}: {canonical}: {e}")
+            return False
+        manifest.update(key, status=DONE, error=None, seconds=time.monotonic() - start)
+        print(f"done      {key}: {canonical} ({time.monotonic() - start:.0f}s)")
+        return True
+
+
+async def run_batch(rows, output_dir, concurrency, strategy):
+    # Every job keeps a few blocking HTTP and image calls on threads at once
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency * 4))
+    manifest = Manifest(os.path.join(output_dir, "manifest.json"))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    tasks = []
+    for index, (username, dream) in enumerate(rows):
+        key = str(index)
+        if manifest.entry(key, username, dream)["status"] == DONE:
+            print(f"skipped   {key}: {username} (already done)")
+            continue
+        tasks.append(run_row(manifest, key, username, dream, output_dir, semaphore, strategy))
+    results = await asyncio.gather(*tasks)
+    return len(rows) - len(tasks), results.count(True), results.count(False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate dream images for a CSV of (username, dream) rows")
+    parser.add_argument("csv", help="file of username,dream rows")
+    parser.add_argument("--output", default="batch_results", help="results directory, holds manifest.json")
+    parser.add_argument("--concurrency", type=int, default=st.secrets.get("GENERATION_MAX_CONCURRENT", 4),
+                        help="rows in flight at once; keep within the Leonardo plan's concurrency limit")
+    parser.add_argument("--strategy", choices=generation_pipeline.GENERATION_STRATEGIES,
+                        help="generation strategy (defaults to GENERATION_STRATEGY from secrets)")
+    parser.add_argument("--log-spans", action="store_true", help="log every pipeline stage as a JSON line")
+    args = parser.parse_args()
+
+    if args.log_spans:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    generation_pipeline.configure(st.secrets)
+    os.makedirs(args.output, exist_ok=True)
+
+    started = time.monotonic()
+    skipped, done, failed = asyncio.run(run_batch(read_rows(args.csv), args.output, args.concurrency, args.strategy))
+    print(f"{done} done, {failed} failed, {skipped} skipped in {time.monotonic() - started:.0f}s; "
+          f"manifest: {os.path.join(args.output, 'manifest.json')}")
@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from streamlit import config as st_config
+
+from fake_leonardo import FakeLeonardoServer
+from fake_smtp import FakeSMTPServer
+from fake_translator import FakeTranslatorBackend
+from metrics import percentile, stage_metrics
+
+# Runs N simulated guests through login -> submit -> select -> email against
+# the local fakes (Leonardo, SMTP, translator) and reports end-to-end latency,
+# API calls per dream and peak memory. Run from the repository root:
+#     python bench_load.py --guests 45
+
+
+def write_secrets(path, leonardo, smtp, guests, workdir, args):
+    host, port = smtp.address
+    photos = sorted(os.listdir("images"))
+    settings = {
+        "LEONARDO_API_KEY": "load-test",
+        "LEONARDO_API_URL": leonardo.base_url,
+        "GENERATION_MAX_CONCURRENT": args.max_concurrent,
+        "GENERATION_STRATEGY": args.strategy,
+        "TRANSLATION_BACKEND": "fake",
+        "TRANSLATION_CACHE_PATH": os.path.join(workdir, "translation_cache.json"),
+        "ARTIFACT_DIR": os.path.join(workdir, "artifacts"),
+        "RESULT_CACHE_DIR": os.path.join(workdir, "result_cache"),
+        "INIT_IMAGE_CACHE_PATH": os.path.join(workdir, "init_image_cache.json"),
+        "USER_STORAGE_PATH": os.path.join(workdir, "user_data.db"),
+        "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.db"),
+        "LEONARDO_RATE_LIMIT_PATH": os.path.join(workdir, "rate_limits.db"),
+        "EMAIL_ADDRESS": "dreams@example.com",
+        "EMAIL_PASSWORD": "load-test",
+        "RECIPIENT_EMAIL": "inbox@example.com",
+        "ADDITIONAL_RECIPIENT": "copy@example.com",
+        "SMTP_HOST": host,
+        "SMTP_PORT": port,
+        "SMTP_USE_TLS": False,
+    }
+    # JSON scalars are valid TOML values for everything written here
+    lines = [f"{key} = {json.dumps(value)}" for key, value in settings.items()]
+    # Seed the waiter with the fakes' mean durations, so it doesn't wait for the real API's priors
+    lines.append(f"GENERATION_EXPECTED_DURATIONS = {{initial = {sum(args.initial) / 2}, final = {sum(args.final) / 2}}}")
+    lines.append("[credentials]")
+    lines.append(f"usernames = {json.dumps([name for name, _ in guests], ensure_ascii=False)}")
+    lines.append(f"passwords = {json.dumps([password for _, password in guests])}")
+    lines.append("[user_to_file]")
+    for i, (name, _) in enumerate(guests):
+        lines.append(f"{json.dumps(name)} = {json.dumps(photos[i % len(photos)], ensure_ascii=False)}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def run_guest(app, name, password, dream, poll_interval, timeout):
+    # Returns per-step timings in seconds; raises on any failure
+    from generation_jobs import DONE, FAILED
+    from mail_queue import SENT, FAILED as MAIL_FAILED
+
+    start = time.monotonic()
+    timings = {}
+    if not app.authenticate(name, password):
+        raise RuntimeError(f"login failed for {name}")
+    timings["login"] = time.monotonic() - start
+
+    if not app.user_storage.try_consume_image(name):
+        raise RuntimeError(f"{name} has no attempts left")
+    job_manager = app.get_job_manager()
+    job_id = app.submit_generation(name, dream)
+    while True:
+        job = job_manager.get(job_id)
+        if job.status == DONE:
+            break
+        if job.status == FAILED:
+            raise RuntimeError(job.error.splitlines()[0])
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f"generation for {name} took longer than {timeout}s")
+        time.sleep(poll_interval)
+    timings["generate"] = time.monotonic() - start - timings["login"]
+
+    # The guest picks one of the results, which is encoded and mailed
+    selected = time.monotonic()
+    handle = random.choice(job.result)
+    artifact_store = app.get_artifact_store()
+    encoder = app.get_attachment_encoder()
+    image_data = encoder.encode(lambda: artifact_store.full_image(handle), cache_key=handle)
+    message_id = app.send_email("New Dream Image Generated", dream, image_data, name,
+                                additional_recipient=app.st.secrets["ADDITIONAL_RECIPIENT"],
+                                image_name=f"dream_image.{encoder.extension}", image_subtype=encoder.mime_subtype)
+    if message_id is None:
+        raise RuntimeError(f"email for {name} was not queued")
+    mail_queue = app.get_mail_queue()
+    while True:
+        status = mail_queue.status(message_id)["status"]
+        if status == SENT:
+            break
+        if status == MAIL_FAILED:
+            raise RuntimeError(f"email for {name} failed")
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f"email for {name} took longer than {timeout}s")
+        time.sleep(poll_interval)
+    timings["email"] = time.monotonic() - selected
+    timings["total"] = time.monotonic() - start
+    return timings
+
+
+def format_seconds(values):
+    if not values:
+        return "n/a"
+    return " ".join(f"p{q}={percentile(values, q / 100):.2f}s" for q in (50, 95, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the dream flow against local fakes")
+    parser.add_argument("--guests", type=int, default=20)
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="seconds over which guests arrive")
+    parser.add_argument("--max-concurrent", type=int, default=4)
+    parser.add_argument("--strategy", default="two_phase")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--initial", type=float, nargs=2, default=(2.0, 4.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--final", type=float, nargs=2, default=(4.0, 8.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--api-latency", type=float, default=0.05)
+    parser.add_argument("--api-failure-rate", type=float, default=0.0)
+    parser.add_argument("--api-rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--smtp-latency", type=float, default=0.01)
+    parser.add_argument("--smtp-failure-rate", type=float, default=0.0)
+    parser.add_argument("--translate-latency", type=float, default=0.3)
+    parser.add_argument("--translate-failure-rate", type=float, default=0.0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    leonardo = FakeLeonardoServer(durations={1: tuple(args.initial), 4: tuple(args.final)},
+                                  latency=args.api_latency, failure_rate=args.api_failure_rate,
+                                  rate_limit_rate=args.api_rate_limit_rate).start()
+    smtp = FakeSMTPServer(latency=args.smtp_latency, failure_rate=args.smtp_failure_rate).start()
+    translator_backend = FakeTranslatorBackend(latency=args.translate_latency, failure_rate=args.translate_failure_rate)
+
+    workdir = tempfile.mkdtemp(prefix="dream-load-test-")
+    guests = [(f"guest {i}", f"password-{i}") for i in range(args.guests)]
+    secrets_path = os.path.join(workdir, "secrets.toml")
+    write_secrets(secrets_path, leonardo, smtp, guests, workdir, args)
+    st_config.set_option("secrets.files", [secrets_path])
+
+    # The app reads its configuration at import time, so it is imported only now
+    import translation
+    translation.BACKENDS["fake"] = lambda: translator_backend
+    import streamlit_app as app
+
+    results = []
+    errors = []
+    lock = threading.Lock()
+
+    def guest(index):
+        name, password = guests[index]
+        try:
+            timings = run_guest(app, name, password, f"אני חולם על טיסה מעל העיר מספר {index}",
+                                args.poll_interval, args.timeout)
+            with lock:
+                results.append(timings)
+        except Exception as e:
+            with lock:
+                errors.append(f"{name}: {e}")
+
+    started = time.monotonic()
+    threads = []
+    for index in range(args.guests):
+        thread = threading.Thread(target=guest, args=(index,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if args.guests > 1:
+            time.sleep(args.ramp_up / (args.guests - 1))
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    calls = Counter(leonardo.calls)
+    # Every guest submits one dream, including the ones that failed
+    dreams = max(args.guests, 1)
+    report = {
+        "guests": args.guests,
+        "completed": len(results),
+        "failed": len(errors),
+        "wall_seconds": round(elapsed, 2),
+        "latency": {
+            step: {f"p{q}": round(percentile([r[step] for r in results], q / 100), 3) for q in (50, 95, 99)}
+            for step in ("total", "generate", "email")
+        } if results else {},
+        "api_calls_per_dream": {name: round(count / dreams, 2) for name, count in sorted(calls.items())},
+        "api_calls_total": sum(calls.values()),
+        "translate_calls": translator_backend.calls,
+        "smtp_connections": smtp.connections,
+        "smtp_rejected": smtp.rejected,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        # Per-stage p50/p95 from the pipeline's own spans
+        "stages": {
+            stage: {"count": entry["count"], "errors": entry["errors"],
+                    "p50": round(entry["p50_seconds"], 3), "p95": round(entry["p95_seconds"], 3)}
+            for stage, entry in sorted(stage_metrics.summary().items())
+        },
+        "errors": errors,
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print(f"Guests: {report['guests']}  completed: {report['completed']}  failed: {report['failed']}  "
+              f"wall time: {report['wall_seconds']}s")
+        for step in ("total", "generate", "email"):
+            print(f"{step:>9}: {format_seconds([r[step] for r in results])}")
+        print(f"API calls per dream: {sum(calls.values()) / dreams:.2f} "
+              + ", ".join(f"{name}={value}" for name, value in report["api_calls_per_dream"].items()))
+        print(f"Translator calls: {report['translate_calls']}  SMTP connections: {report['smtp_connections']}  "
+              f"SMTP rejections: {report['smtp_rejected']}")
+        print(f"Peak memory (RSS): {report['peak_rss_mb']} MB")
+        for stage, entry in report["stages"].items():
+            print(f"  {stage:>20}: n={entry['count']} errors={entry['errors']} p50={entry['p50']}s p95={entry['p95']}s")
+        for error in errors:
+            print(f"  error: {error}")
+
+    leonardo.stop()
+    smtp.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Measures how long streamlit_app.py takes to import and render its first run
+# in a fresh process (cold start), and how long each later rerun of the login
+# and main pages takes, timing AppTest.run() against a local fake Leonardo API.
+# AppTest waits for the script with short sleeps, so compare runs of this script
+# with each other rather than with a browser. Run from the repository root:
+#     python bench_startup.py --reruns 50
+
+CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+from fake_leonardo import FakeLeonardoServer
+
+settings = json.loads(sys.argv[1])
+reruns = int(sys.argv[2])
+fake = FakeLeonardoServer().start()
+settings["LEONARDO_API_URL"] = fake.base_url
+ready = time.perf_counter()
+
+def new_app(authenticated):
+    at = AppTest.from_file("streamlit_app.py", default_timeout=60)
+    for key, value in settings.items():
+        at.secrets[key] = value
+    if authenticated:
+        at.session_state.authenticated = True
+        at.session_state.username = settings["credentials"]["usernames"][0]
+    return at
+
+def timed_runs(at, count):
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        at.run()
+        times.append(time.perf_counter() - start)
+        if at.exception:
+            raise SystemExit(at.exception[0].message)
+    return times
+
+login = new_app(False)
+result = {
+    "harness_seconds": ready - t0,
+    "cold": timed_runs(login, 1)[0],
+    "login_reruns": timed_runs(login, reruns),
+    "main_reruns": timed_runs(new_app(True), reruns + 1)[1:],
+}
+fake.stop()
+print(json.dumps(result))
+"""
+
+
+def summarize(values):
+    ordered = sorted(values)
+    return {
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 2),
+        "p50_ms": round(1000 * ordered[len(ordered) // 2], 2),
+        "p95_ms": round(1000 * ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cold start and rerun time of the Streamlit app")
+    parser.add_argument("--reruns", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=3, help="fresh processes for the cold start measurement")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="dream-bench-")
+    photos = sorted(os.listdir("images"))
+    settings = {
+        "LEONARDO_API_KEY": "bench",
+        "TRANSLATION_BACKEND": "offline",
+        "TRANSLATION_CACHE_PATH": os.path.join(workdir, "translation_cache.json"),
+        "ARTIFACT_DIR": os.path.join(workdir, "artifacts"),
+        "INIT_IMAGE_CACHE_PATH": os.path.join(workdir, "init_image_cache.json"),
+        "USER_STORAGE_PATH": os.path.join(workdir, "user_data.db"),
+        "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.db"),
+        "LEONARDO_RATE_LIMIT_PATH": os.path.join(workdir, "rate_limits.db"),
+        "EMAIL_ADDRESS": "dreams@example.com",
+        "EMAIL_PASSWORD": "bench",
+        "RECIPIENT_EMAIL": "inbox@example.com",
+        "ADDITIONAL_RECIPIENT": "copy@example.com",
+        "credentials": {"usernames": ["guest"], "passwords": ["password"]},
+        "user_to_file": {"guest": photos[0]},
+    }
+
+    runs = []
+    for _ in range(args.rounds):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD, json.dumps(settings), str(args.reruns)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    report = {
+        "cold_start": summarize([run["cold"] for run in runs]),
+        "login_rerun": summarize([t for run in runs for t in run["login_reruns"]]),
+        "main_rerun": summarize([t for run in runs for t in run["main_reruns"]]),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, stats in report.items():
+            print(f"{name:>12}: mean={stats['mean_ms']}ms p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+from PIL import Image, ImageDraw
+
+BORDER_WIDTH = 2
+OVERLAY_POSITION = (10, 10)
+
+# The overlay is rendered once per photo (see photo_store) and pasted into each
+# result as it is downloaded. Pillow releases the GIL while pasting, so the
+# pipeline's per-image threads composite the four results side by side.
+
+
+def render_overlay(thumbnail, max_size=(300, 300), border=BORDER_WIDTH):
+    # Work on a copy so the shared source thumbnail is never resized in place
+    thumb = thumbnail.convert("RGBA") if thumbnail.mode != "RGBA" else thumbnail.copy()
+    thumb.thumbnail(max_size, Image.LANCZOS)
+
+    # Transparent box with a white border, the photo fully opaque inside it
+    thumb_w, thumb_h = thumb.size
+    overlay = Image.new("RGBA", (thumb_w + 2 * border, thumb_h + 2 * border), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(overlay)
+    draw.rectangle([0, 0, thumb_w + 2 * border - 1, thumb_h + 2 * border - 1], outline=(255, 255, 255, 255), width=border)
+    overlay.paste(thumb, (border, border))
+    return overlay
+
+
+def apply_overlay(main_image, overlay, position=OVERLAY_POSITION):
+    # Pastes in place into the (freshly downloaded) result; the overlay is only read
+    if main_image.mode not in ("RGB", "RGBA"):
+        main_image = main_image.convert("RGB")
+    main_image.paste(overlay, position, overlay)
+    return main_image
+
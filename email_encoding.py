@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+# File extension and MIME subtype per output format
+FORMATS = {"JPEG": ("jpg", "jpeg"), "WEBP": ("webp", "webp"), "PNG": ("png", "png")}
+
+
+class AttachmentEncoder:
+    # Encodes the selected result for email within a pixel and byte budget,
+    # lowering quality first and then resolution until it fits.
+    def __init__(self, format="JPEG", quality=85, min_quality=55, max_pixels=1600 * 1600,
+                 max_bytes=1_500_000, progressive=True, cache_size=64):
+        self.format = format.upper()
+        self.quality = quality
+        self.min_quality = min_quality
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.progressive = progressive
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def extension(self):
+        return FORMATS[self.format][0]
+
+    @property
+    def mime_subtype(self):
+        return FORMATS[self.format][1]
+
+    def _save(self, image, quality):
+        buffer = BytesIO()
+        options = {}
+        if self.format == "JPEG":
+            options = {"quality": quality, "optimize": True, "progressive": self.progressive}
+        elif self.format == "WEBP":
+            options = {"quality": quality, "method": 4}
+        image.save(buffer, format=self.format, **options)
+        return buffer.getvalue()
+
+    def _fit_pixels(self, image):
+        pixels = image.width * image.height
+        if pixels <= self.max_pixels:
+            return image
+        scale = (self.max_pixels / pixels) ** 0.5
+        return image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+
+    def _encode(self, image):
+        if self.format != "PNG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image = self._fit_pixels(image)
+        while True:
+            quality = self.quality
+            data = self._save(image, quality)
+            while len(data) > self.max_bytes and self.format != "PNG" and quality > self.min_quality:
+                quality = max(quality - 10, self.min_quality)
+                data = self._save(image, quality)
+            if len(data) <= self.max_bytes or min(image.size) <= 256:
+                return data
+            image = image.resize((int(image.width * 0.75), int(image.height * 0.75)), Image.LANCZOS)
+
+    def encode(self, image, cache_key=None):
+        # Cached per selected image so a retry doesn't pay for the encode again.
+        # image may be a callable that loads it, so a cache hit doesn't open the file.
+        if cache_key is not None:
+            with self.lock:
+                if cache_key in self.cache:
+                    self.cache.move_to_end(cache_key)
+                    return self.cache[cache_key]
+        data = self._encode(image() if callable(image) else image)
+        if cache_key is not None:
+            with self.lock:
+                self.cache[cache_key] = data
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return data
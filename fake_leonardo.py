@@ -0,0 +1,213 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import requests
+
+# Local stand-in for the parts of the Leonardo REST API the app uses, so the
+# generation flow and its polling behaviour can be exercised offline.
+
+API_PREFIX = "/api/rest/v1"
+
+
+def _placeholder_jpeg(seed, size=(512, 512)):
+    from PIL import Image
+
+    rng = random.Random(seed)
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class FakeLeonardoServer:
+    def __init__(self, host="127.0.0.1", port=0, durations=None, callback_url=None, callback_token=None,
+                 latency=0.0, failure_rate=0.0, rate_limit_rate=0.0):
+        # Seconds a job takes, per number of requested images: (min, max)
+        self.durations = durations or {1: (2.0, 4.0), 4: (4.0, 8.0)}
+        # Added delay per request, and the fraction of API requests answered with 500 / 429
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.callback_url = callback_url
+        self.callback_token = callback_token
+        self.jobs = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.thread = None
+
+    @property
+    def host_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self):
+        return self.host_url + API_PREFIX
+
+    def _job_duration(self, num_images):
+        low, high = self.durations.get(num_images, self.durations[max(self.durations)])
+        return random.uniform(low, high)
+
+    def create_job(self, payload):
+        generation_id = str(uuid.uuid4())
+        num_images = int(payload.get("num_images", 1))
+        job = {
+            "id": generation_id,
+            "created": time.monotonic(),
+            "duration": self._job_duration(num_images),
+            "num_images": num_images,
+            "payload": payload,
+        }
+        with self.lock:
+            self.jobs[generation_id] = job
+        if self.callback_url:
+            timer = threading.Timer(job["duration"], self._push_completion, args=(generation_id,))
+            timer.daemon = True
+            timer.start()
+        return generation_id
+
+    def job_status(self, generation_id):
+        with self.lock:
+            job = self.jobs.get(generation_id)
+        if job is None:
+            return None
+        complete = time.monotonic() - job["created"] >= job["duration"]
+        images = [
+            {"id": f"{generation_id}-{i}", "url": f"{self.host_url}/files/{generation_id}/{i}.jpg"}
+            for i in range(job["num_images"])
+        ] if complete else []
+        return {"id": generation_id, "status": "COMPLETE" if complete else "PENDING", "generated_images": images}
+
+    def _push_completion(self, generation_id):
+        status = self.job_status(generation_id)
+        body = {"type": "image_generation.complete", "data": {"object": {"id": generation_id, "status": status["status"], "images": status["generated_images"]}}}
+        headers = {"Authorization": f"Bearer {self.callback_token}"} if self.callback_token else {}
+        try:
+            requests.post(self.callback_url, json=body, headers=headers, timeout=5)
+        except requests.RequestException:
+            pass
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status, body=None, content_type="application/json"):
+                data = b""
+                if body is not None:
+                    data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length)
+
+            def _inject_faults(self):
+                # Returns True if the request was answered with an injected error
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if not self.path.startswith(API_PREFIX):
+                    return False
+                roll = random.random()
+                if roll < fake.rate_limit_rate:
+                    fake.calls["rate_limited"] += 1
+                    self.send_response(429)
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return True
+                if roll < fake.rate_limit_rate + fake.failure_rate:
+                    fake.calls["failed"] += 1
+                    self._reply(500, {"error": "injected failure"})
+                    return True
+                return False
+
+            def do_POST(self):
+                body = self._read_body()
+                if self._inject_faults():
+                    return
+                if self.path == f"{API_PREFIX}/generations":
+                    fake.calls["create_generation"] += 1
+                    generation_id = fake.create_job(json.loads(body or b"{}"))
+                    self._reply(200, {"sdGenerationJob": {"generationId": generation_id, "apiCreditCost": 0}})
+                elif self.path == f"{API_PREFIX}/init-image":
+                    fake.calls["init_image"] += 1
+                    image_id = str(uuid.uuid4())
+                    self._reply(200, {"uploadInitImage": {
+                        "id": image_id,
+                        "url": f"{fake.host_url}/upload/{image_id}",
+                        "fields": json.dumps({"key": f"init/{image_id}.jpg"}),
+                    }})
+                elif self.path.startswith("/upload/"):
+                    fake.calls["upload"] += 1
+                    self._reply(204)
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_GET(self):
+                if self._inject_faults():
+                    return
+                match = re.fullmatch(rf"{API_PREFIX}/generations/([\w-]+)", self.path)
+                if match:
+                    fake.calls["get_generation"] += 1
+                    status = fake.job_status(match.group(1))
+                    if status is None:
+                        self._reply(404, {"error": "not found"})
+                    else:
+                        self._reply(200, {"generations_by_pk": status})
+                    return
+                match = re.fullmatch(r"/files/([\w-]+)/(\d+)\.jpg", self.path)
+                if match:
+                    fake.calls["download"] += 1
+                    self._reply(200, _placeholder_jpeg(self.path), content_type="image/jpeg")
+                    return
+                self._reply(404, {"error": "not found"})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local fake Leonardo API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--initial", type=float, nargs=2, default=(2.0, 4.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--final", type=float, nargs=2, default=(4.0, 8.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--callback-url")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeLeonardoServer(port=args.port, durations={1: tuple(args.initial), 4: tuple(args.final)},
+                              callback_url=args.callback_url, latency=args.latency,
+                              failure_rate=args.failure_rate, rate_limit_rate=args.rate_limit_rate)
+    print(f"Fake Leonardo API listening on {fake.base_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
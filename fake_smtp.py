@@ -0,0 +1,120 @@
+import argparse
+import random
+import socketserver
+import threading
+import time
+from email import message_from_bytes
+
+# Minimal local SMTP stand-in (no TLS) that accepts any login and keeps
+# received messages in memory, so the mail queue can run offline.
+
+
+class FakeSMTPServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, failure_rate=0.0):
+        # Added delay per command, and the fraction of messages rejected with a temporary 451
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rejected = 0
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode("ascii") + b"\r\n")
+
+            def handle(self):
+                with fake.lock:
+                    fake.connections += 1
+                sender, recipients = None, []
+                self.reply("220 fake-smtp ready")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    if fake.latency:
+                        time.sleep(fake.latency)
+                    command = line.decode("utf-8", "replace").strip()
+                    verb = command.split(" ", 1)[0].upper()
+                    if verb == "EHLO":
+                        self.reply("250-fake-smtp")
+                        self.reply("250-AUTH PLAIN LOGIN")
+                        self.reply("250 8BITMIME")
+                    elif verb == "HELO":
+                        self.reply("250 fake-smtp")
+                    elif verb == "AUTH":
+                        parts = command.split()
+                        if parts[1].upper() == "LOGIN":
+                            for _ in range(2 - (len(parts) > 2)):
+                                self.reply("334 ")
+                                self.rfile.readline()
+                        self.reply("235 Authentication successful")
+                    elif verb == "MAIL":
+                        sender, recipients = command.split(":", 1)[1].strip(), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(command.split(":", 1)[1].strip())
+                        self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        while True:
+                            data_line = self.rfile.readline()
+                            if data_line in (b".\r\n", b".\n", b""):
+                                break
+                            data.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                        if random.random() < fake.failure_rate:
+                            with fake.lock:
+                                fake.rejected += 1
+                            self.reply("451 Injected temporary failure")
+                            continue
+                        with fake.lock:
+                            fake.messages.append({
+                                "sender": sender,
+                                "recipients": recipients,
+                                "message": message_from_bytes(b"".join(data)),
+                            })
+                        self.reply("250 OK queued")
+                    elif verb in ("RSET", "NOOP"):
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local fake SMTP server")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeSMTPServer(port=args.port, latency=args.latency, failure_rate=args.failure_rate)
+    print("Fake SMTP server listening on %s:%d" % fake.address)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
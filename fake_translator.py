@@ -0,0 +1,22 @@
+import random
+import threading
+import time
+
+# Translation backend stand-in with configurable latency and failure injection,
+# pluggable into translation.Translator like the real backends.
+
+
+class FakeTranslatorBackend:
+    def __init__(self, latency=0.3, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def translate(self, text):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise ConnectionError("injected translation failure")
+        return f" dream about {text}"
@@ -0,0 +1,292 @@
+import json
+import time
+import uuid
+from collections import namedtuple
+
+from sqlite_store import SQLiteStore
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Until we have seen real jobs, assume a generation takes about this long (seconds)
+DEFAULT_JOB_DURATION = 90.0
+
+# What a running job is doing right now, in pipeline order. started is a wall
+# clock time; expected is the estimated seconds for the stage, done/total count
+# images for the per-image stages.
+PROGRESS_STAGES = ("queued", "uploading", "translating", "initial_generation", "final_generation",
+                   "downloading", "compositing")
+ProgressEvent = namedtuple("ProgressEvent", ["stage", "started", "expected", "done", "total"],
+                           defaults=(None, None, None))
+
+
+class Job:
+    def __init__(self, username, priority=0):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.priority = priority
+        self.status = QUEUED
+        self.result = None
+        self.partial_results = {}
+        self.progress = ProgressEvent("queued", time.time())
+        self.payload = None
+        # Progress that lets an interrupted job pick up where it left off (e.g. Leonardo generation ids)
+        self.checkpoint = {}
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def is_active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    def add_partial_result(self, index, result):
+        self.partial_results[index] = result
+
+    def save_checkpoint(self, key, value):
+        self.checkpoint[key] = value
+
+    def clear_checkpoint(self, key):
+        self.checkpoint.pop(key, None)
+
+    def report_progress(self, stage, expected=None, done=None, total=None):
+        if stage not in PROGRESS_STAGES:
+            raise ValueError(f"Unknown progress stage: {stage}")
+        self.progress = ProgressEvent(stage, time.time(), expected, done, total)
+
+
+class SQLiteJobQueue(SQLiteStore):
+    # Job queue shared between the app and worker.py processes through one
+    # WAL-mode SQLite file. The app submits and polls; workers claim queued
+    # jobs in (priority, arrival) order and write partial and final results.
+    # Results are stored as JSON; result_type turns each stored item back into
+    # the app's value (e.g. ImageHandle).
+    #
+    # Jobs outlive both the browser session and the process running them:
+    # running jobs carry a heartbeat, and one whose worker stopped beating for
+    # stale_after seconds is queued again with its checkpoint intact.
+    def __init__(self, path="jobs.db", max_concurrent=4, keep_finished=3600, result_type=None, stale_after=30):
+        super().__init__(path)
+        self.max_concurrent = max_concurrent
+        self.keep_finished = keep_finished
+        self.result_type = result_type
+        self.stale_after = stale_after
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " id TEXT UNIQUE NOT NULL,"
+                " username TEXT NOT NULL,"
+                " priority INTEGER NOT NULL DEFAULT 0,"
+                " payload TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " result TEXT,"
+                " error TEXT,"
+                " worker TEXT,"
+                " checkpoint TEXT NOT NULL DEFAULT '{}',"
+                " progress TEXT,"
+                " heartbeat REAL,"
+                " created REAL NOT NULL,"
+                " started REAL,"
+                " finished REAL)"
+            )
+            # Queues created before jobs were resumable
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "checkpoint" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN checkpoint TEXT NOT NULL DEFAULT '{}'")
+            if "heartbeat" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+            if "progress" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN progress TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, seq)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS partial_results ("
+                " job_id TEXT NOT NULL,"
+                " idx INTEGER NOT NULL,"
+                " result TEXT NOT NULL,"
+                " PRIMARY KEY (job_id, idx))"
+            )
+
+    def _decode(self, value):
+        return self.result_type(*value) if self.result_type else value
+
+    def submit(self, username, payload, priority=0):
+        job_id = uuid.uuid4().hex
+        with self.connection() as conn:
+            self._prune(conn)
+            conn.execute(
+                "INSERT INTO jobs (id, username, priority, payload, status, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, username, priority, json.dumps(payload), QUEUED, time.time()),
+            )
+        return job_id
+
+    def claim(self, worker=None):
+        # Atomically takes the next queued job; returns (job, payload) or None.
+        # At most max_concurrent jobs run at once across every worker thread
+        # and process sharing the queue, however many of those there are.
+        with self.connection() as conn:
+            now = time.time()
+            # Jobs whose worker died (e.g. a restarted server) go back to the queue
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND (heartbeat IS NULL OR heartbeat < ?)",
+                (QUEUED, RUNNING, now - self.stale_after),
+            )
+            running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (RUNNING,)).fetchone()[0]
+            if running >= self.max_concurrent:
+                return None
+            row = conn.execute(
+                "SELECT id, username, priority, payload, created, checkpoint FROM jobs WHERE status = ?"
+                " ORDER BY priority, seq LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, started = ?, heartbeat = ?, worker = ? WHERE id = ?",
+                (RUNNING, now, now, worker, row[0]),
+            )
+        job = QueuedJob(self, row[1], row[2])
+        job.id = row[0]
+        job.status = RUNNING
+        job.created = row[4]
+        job.started = now
+        job.payload = json.loads(row[3])
+        job.checkpoint = json.loads(row[5])
+        return job, job.payload
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        with self.connection() as conn:
+            conn.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ?",
+                             [(time.time(), job_id, RUNNING) for job_id in job_ids])
+
+    def save_checkpoint(self, job_id, checkpoint):
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET checkpoint = ? WHERE id = ?", (json.dumps(checkpoint), job_id))
+
+    def report_progress(self, job_id, progress):
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def add_partial_result(self, job_id, index, result):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO partial_results (job_id, idx, result) VALUES (?, ?, ?)",
+                (job_id, index, json.dumps(result)),
+            )
+
+    def complete(self, job_id, result):
+        with self.connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, finished = ? WHERE id = ?",
+                (DONE, json.dumps(result), time.time(), job_id),
+            )
+
+    def fail(self, job_id, error):
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?", (FAILED, error, time.time(), job_id))
+
+    def get(self, job_id):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT username, priority, status, result, error, created, started, finished, payload, checkpoint, progress"
+            " FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = Job(row[0], row[1])
+        job.id = job_id
+        job.status, job.error, job.created, job.started, job.finished = row[2], row[4], row[5], row[6], row[7]
+        job.payload = json.loads(row[8])
+        job.checkpoint = json.loads(row[9])
+        job.progress = ProgressEvent(*json.loads(row[10])) if row[10] else ProgressEvent("queued", row[5])
+        if row[3] is not None:
+            job.result = [self._decode(item) for item in json.loads(row[3])]
+        for index, raw in conn.execute("SELECT idx, result FROM partial_results WHERE job_id = ?", (job_id,)):
+            job.partial_results[index] = self._decode(json.loads(raw))
+        return job
+
+    def latest_job(self, username):
+        # The user's most recent job that hasn't been discarded, so a returning user can reattach to it
+        row = self._connect().execute(
+            "SELECT id FROM jobs WHERE username = ? ORDER BY seq DESC LIMIT 1", (username,)
+        ).fetchone()
+        return self.get(row[0]) if row else None
+
+    def discard(self, job_id):
+        # True only for the call that actually removed the job, so follow-up
+        # work (like a refund) happens once even if two tabs discard it together
+        with self.connection() as conn:
+            conn.execute("DELETE FROM partial_results WHERE job_id = ?", (job_id,))
+            return conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount > 0
+
+    def queue_position(self, job_id):
+        # 1-based position among queued jobs, or 0 once the job is running
+        row = self._connect().execute(
+            "SELECT COUNT(*) FROM jobs AS other, jobs AS job WHERE job.id = ? AND job.status = ?"
+            " AND other.status = ? AND (other.priority < job.priority OR (other.priority = job.priority AND other.seq <= job.seq))",
+            (job_id, QUEUED, QUEUED),
+        ).fetchone()
+        return row[0]
+
+    def in_flight(self):
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (RUNNING,)).fetchone()[0]
+
+    def queued(self):
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+    @property
+    def average_duration(self):
+        # Mean of the most recent successful jobs, across all workers
+        row = self._connect().execute(
+            "SELECT AVG(finished - started) FROM (SELECT finished, started FROM jobs WHERE status = ?"
+            " ORDER BY finished DESC LIMIT 20)",
+            (DONE,),
+        ).fetchone()
+        return row[0] if row[0] is not None else DEFAULT_JOB_DURATION
+
+    def estimated_wait(self, job_id):
+        job = self.get(job_id)
+        if job is None or not job.is_active:
+            return 0
+        if job.status == RUNNING:
+            return max(self.average_duration - (time.time() - job.started), 0)
+        rounds = (self.queue_position(job_id) - 1) // self.max_concurrent + 1
+        return rounds * self.average_duration + self.average_duration
+
+    def _prune(self, conn):
+        cutoff = time.time() - self.keep_finished
+        conn.execute(
+            "DELETE FROM partial_results WHERE job_id IN (SELECT id FROM jobs WHERE finished IS NOT NULL AND finished < ?)",
+            (cutoff,),
+        )
+        conn.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (cutoff,))
+
+
+class QueuedJob(Job):
+    # A job claimed from SQLiteJobQueue; partial results are written through
+    # so the app can show them while the worker is still running
+    def __init__(self, queue, username, priority=0):
+        super().__init__(username, priority)
+        self.queue = queue
+
+    def add_partial_result(self, index, result):
+        super().add_partial_result(index, result)
+        self.queue.add_partial_result(self.id, index, result)
+
+    def save_checkpoint(self, key, value):
+        super().save_checkpoint(key, value)
+        self.queue.save_checkpoint(self.id, self.checkpoint)
+
+    def clear_checkpoint(self, key):
+        super().clear_checkpoint(key)
+        self.queue.save_checkpoint(self.id, self.checkpoint)
+
+    def report_progress(self, stage, expected=None, done=None, total=None):
+        super().report_progress(stage, expected, done, total)
+        self.queue.report_progress(self.id, self.progress)
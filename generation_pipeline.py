@@ -0,0 +1,385 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+
+from leonardo_client import LeonardoClient, LeonardoAPIError, LEONARDO_API_BASE
+from generation_waiter import GenerationWaiter, CallbackReceiver, DurationStats, GenerationTimeout
+from init_image_cache import InitImageCache
+from photo_store import PhotoStore
+from compositing import apply_overlay
+from translation import Translator, BACKENDS as TRANSLATION_BACKENDS, normalize_text
+from artifact_store import ArtifactStore
+from metrics import strategy_stats, stage_metrics, span, set_span_tags
+from pipeline import Stage, run_graph, Prefetcher
+from rate_limiter import RateLimiter, SQLiteBucketStore, MemoryBucketStore
+from result_cache import ResultCache
+from user_directory import UserDirectory
+
+# The dream generation pipeline, free of any Streamlit dependency so it can run
+# inside the app process or in worker.py. Configuration comes from a mapping
+# with the same keys as .streamlit/secrets.toml, set once with configure().
+
+logger = logging.getLogger(__name__)
+
+settings = {}
+# Only one process per host can own LEONARDO_CALLBACK_PORT; the others poll
+receive_callbacks = True
+user_directory = None
+
+
+# directory is a UserDirectory the caller already built from the same settings
+# (user_data_storage's, in the app and worker.py), so there is one per process
+def configure(new_settings, callbacks=True, directory=None):
+    global settings, receive_callbacks, user_directory
+    settings = new_settings
+    receive_callbacks = callbacks
+    user_directory = directory
+
+
+def setting(name, default=None):
+    return settings.get(name, default)
+
+
+# Token buckets for Leonardo calls, shared through SQLite by every process on the host
+# (an empty LEONARDO_RATE_LIMIT_PATH keeps them in memory, per process)
+@functools.lru_cache(maxsize=None)
+def get_rate_limiter():
+    path = setting("LEONARDO_RATE_LIMIT_PATH", "rate_limits.db")
+    limiter = RateLimiter(setting("LEONARDO_RATE_LIMITS", {}),
+                          store=SQLiteBucketStore(path) if path else MemoryBucketStore())
+    limiter.register_gauges(stage_metrics)
+    return limiter
+
+
+# One pooled Leonardo client per process, shared by all jobs
+@functools.lru_cache(maxsize=None)
+def get_leonardo_client():
+    return LeonardoClient(settings["LEONARDO_API_KEY"], base_url=setting("LEONARDO_API_URL", LEONARDO_API_BASE),
+                          read_timeout=setting("LEONARDO_TIMEOUT", 30), max_retries=setting("LEONARDO_MAX_RETRIES", 4),
+                          rate_limiter=get_rate_limiter())
+
+
+@functools.lru_cache(maxsize=None)
+def get_generation_waiter():
+    receiver = None
+    # Optional port for Leonardo's completion webhook, served by the process configured
+    # to own it (the app with inline workers, or the first worker.py process). A push only
+    # wakes jobs in that process; every other waiter, and all of them when unset, polls.
+    port = setting("LEONARDO_CALLBACK_PORT")
+    if port and receive_callbacks:
+        try:
+            receiver = CallbackReceiver(port=int(port), token=setting("LEONARDO_CALLBACK_TOKEN")).start()
+        except OSError as e:
+            # E.g. a second replica on the same host; polling alone still finishes the job
+            logger.warning("Not receiving Leonardo callbacks on port %s: %s", port, e)
+    # Expected seconds per phase until real jobs have been observed, e.g. {initial = 20, final = 45}
+    expected = setting("GENERATION_EXPECTED_DURATIONS")
+    stats = DurationStats(defaults=dict(expected)) if expected else None
+    # Hard limit for a single generation phase, so a stuck job can't poll forever
+    return GenerationWaiter(get_leonardo_client(), stats=stats, receiver=receiver,
+                            deadline=setting("GENERATION_DEADLINE", 300))
+
+
+@functools.lru_cache(maxsize=None)
+def get_init_image_cache():
+    return InitImageCache(setting("INIT_IMAGE_CACHE_PATH", "init_image_cache.json"),
+                          ttl=setting("INIT_IMAGE_TTL", 7 * 24 * 3600))
+
+
+@functools.lru_cache(maxsize=None)
+def get_translator():
+    return Translator(TRANSLATION_BACKENDS[setting("TRANSLATION_BACKEND", "google")](),
+                      cache_path=setting("TRANSLATION_CACHE_PATH", "translation_cache.json"),
+                      max_disk_entries=setting("TRANSLATION_CACHE_MAX_ENTRIES", 10000),
+                      timeout=setting("TRANSLATION_TIMEOUT", 5))
+
+
+@functools.lru_cache(maxsize=None)
+def get_photo_store():
+    return PhotoStore()
+
+
+@functools.lru_cache(maxsize=None)
+def get_artifact_store():
+    return ArtifactStore(setting("ARTIFACT_DIR", "artifacts"),
+                         max_disk_bytes=setting("ARTIFACT_MAX_DISK_BYTES", 2 * 1024 ** 3))
+
+
+# Opt-in cache that serves identical dreams from earlier results instead of a new generation
+@functools.lru_cache(maxsize=None)
+def get_result_cache():
+    if not setting("RESULT_CACHE_ENABLED", False):
+        return None
+    return ResultCache(setting("RESULT_CACHE_DIR", "result_cache"),
+                       max_bytes=setting("RESULT_CACHE_MAX_BYTES", 1024 ** 3))
+
+
+def get_user_directory():
+    global user_directory
+    if user_directory is None:
+        user_directory = UserDirectory.from_settings(settings)
+    return user_directory
+
+
+@functools.lru_cache(maxsize=None)
+def get_prefetcher():
+    return Prefetcher()
+
+
+def translate_text(text):
+    return get_translator().translate(text)
+
+
+def report_progress(job, stage, **fields):
+    if job is not None:
+        job.report_progress(stage, **fields)
+
+
+async def upload_image_to_leonardo(image_file):
+    # Assume all images are JPEGs
+    return await get_leonardo_client().upload_init_image(image_file, extension="jpg")
+
+
+MODEL_ID = "1e60896f-3c26-4296-8ecc-53e2afecc132"  # Leonardo Diffusion XL
+
+# two_phase: a 1-image prompt-only job whose result is used as a second reference for the final 4
+# single_phase: the final 4 images with only the uploaded photo as character reference
+# prompt_only: the final 4 images from the prompt alone (used automatically without a photo)
+GENERATION_STRATEGIES = ("two_phase", "single_phase", "prompt_only")
+
+
+def generation_payload(prompt, preset_style, num_images, controlnets=None):
+    payload = {
+        "prompt": prompt,
+        "modelId": MODEL_ID,
+        "presetStyle": preset_style,
+        "photoReal": True,
+        "photoRealVersion": "v2",
+        "alchemy": True,
+        "num_images": num_images,
+        "enhancePrompt": True,
+    }
+    if controlnets is not None:
+        payload["controlnets"] = controlnets
+    return payload
+
+
+def choose_strategy(init_image_id, strategy=None):
+    if not init_image_id:
+        return "prompt_only"
+    strategy = strategy or setting("GENERATION_STRATEGY", "two_phase")
+    if strategy not in GENERATION_STRATEGIES:
+        raise ValueError(f"Unknown generation strategy: {strategy}")
+    return strategy
+
+
+async def wait_for_generation(waiter, job, generation_id, phase):
+    try:
+        return await waiter.wait(generation_id, phase)
+    except (LeonardoAPIError, GenerationTimeout):
+        # Only a generation that is still running is worth resuming; a retry of
+        # this job submits a new one instead of polling a dead one again
+        if job is not None:
+            job.clear_checkpoint(f"{phase}_generation_id")
+        raise
+
+
+async def generate_image_leonardo(prompt, init_image_id, preset_style, strategy=None, job=None):
+    client = get_leonardo_client()
+    waiter = get_generation_waiter()
+    escaped_prompt = prompt.replace("'", "\\'")
+    # Generation ids are checkpointed on the job, so a resumed job polls the
+    # generations it already paid for instead of creating new ones
+    checkpoint = job.checkpoint if job is not None else {}
+    strategy = checkpoint.get("strategy") or choose_strategy(init_image_id, strategy)
+    if job is not None:
+        job.save_checkpoint("strategy", strategy)
+    start = time.monotonic()
+    credits = 0
+
+    try:
+        controlnets = []
+        if strategy != "prompt_only":
+            controlnets.append({
+                "initImageId": init_image_id,
+                "initImageType": "UPLOADED",
+                "preprocessorId": 133,  # Character Reference Id
+                "strengthType": "High",
+            })
+
+        if strategy == "two_phase":
+            report_progress(job, "initial_generation", expected=waiter.stats.get("initial"))
+            with span("initial_generation", strategy=strategy):
+                # First, generate an image based on the prompt alone
+                initial_id = checkpoint.get("initial_generation_id")
+                if initial_id is None:
+                    try:
+                        initial_job = await client.create_generation(generation_payload(escaped_prompt, preset_style, 1))
+                    except LeonardoAPIError as e:
+                        raise Exception(f"Failed to generate initial image: {e}")
+                    credits += initial_job.get("apiCreditCost") or 0
+                    initial_id = initial_job["generationId"]
+                    if job is not None:
+                        job.save_checkpoint("initial_generation_id", initial_id)
+
+                # Poll for the generated initial image
+                generation_data = await wait_for_generation(waiter, job, initial_id, "initial")
+            controlnets.append({
+                "initImageId": generation_data["generated_images"][0]["id"],
+                "initImageType": "GENERATED",
+                "preprocessorId": 67,  # Character Reference Id
+                "strengthType": "Mid",
+            })
+
+        report_progress(job, "final_generation", expected=waiter.stats.get("final"))
+        with span("final_generation", strategy=strategy):
+            # Now, generate the final images using the references the strategy calls for
+            final_id = checkpoint.get("final_generation_id")
+            if final_id is None:
+                try:
+                    final_job = await client.create_generation(generation_payload(escaped_prompt, preset_style, 4, controlnets))
+                except LeonardoAPIError as e:
+                    raise Exception(f"Failed to generate final images: {e}")
+                credits += final_job.get("apiCreditCost") or 0
+                final_id = final_job["generationId"]
+                if job is not None:
+                    job.save_checkpoint("final_generation_id", final_id)
+
+            # Poll for the generated images
+            generation_data = await wait_for_generation(waiter, job, final_id, "final")
+    except Exception:
+        strategy_stats.record(strategy, time.monotonic() - start, ok=False)
+        raise
+
+    strategy_stats.record(strategy, time.monotonic() - start, credits)
+    return [image["url"] for image in generation_data["generated_images"]]
+
+
+def user_image_path(username):
+    image_path = get_user_directory().photo_path(username)
+    if image_path and os.path.exists(image_path):
+        return image_path
+    return None
+
+
+async def prepare_reference(username):
+    image_path = user_image_path(username)
+    if not image_path:
+        return None, None
+
+    # Preprocessed reference photo and thumbnail, built once per photo
+    photo_store = get_photo_store()
+    filename = os.path.basename(image_path)
+    with span("photo", username=username):
+        photo_bytes = await asyncio.to_thread(photo_store.reference_bytes, filename)
+
+    # Reuse the init image uploaded for this exact photo, if any
+    with span("upload", username=username):
+        init_image_id = await get_init_image_cache().get_or_upload(username, photo_bytes, upload_image_to_leonardo)
+    return init_image_id, photo_store.overlay(filename)
+
+
+async def prepare_prompt(complete_text):
+    with span("translate"):
+        complete_text_english = await asyncio.to_thread(translate_text, complete_text)
+    return "This is a picture of me. Place me according to the description: I am" + complete_text_english
+
+
+def prefetch_reference(username):
+    get_prefetcher().submit(("reference", username), lambda: asyncio.run(prepare_reference(username)))
+
+
+def prefetch_prompt(complete_text):
+    if complete_text:
+        get_prefetcher().submit(("prompt", normalize_text(complete_text)), lambda: asyncio.run(prepare_prompt(complete_text)))
+
+
+async def generate_images_async(username, complete_text, on_image=None, strategy=None, on_cache_hit=None, job=None):
+    client = get_leonardo_client()
+    prefetcher = get_prefetcher()
+    result_cache = get_result_cache()
+    preset_style = "UNPROCESSED"
+
+    async def reference():
+        report_progress(job, "uploading")
+        return await prefetcher.claim(("reference", username), prepare_reference, username)
+
+    async def prompt():
+        report_progress(job, "translating")
+        return await prefetcher.claim(("prompt", normalize_text(complete_text)), prepare_prompt, complete_text)
+
+    async def cached(reference, prompt):
+        if result_cache is None:
+            return None, None
+        init_image_id, _ = reference
+        cache_key = result_cache.key(username, prompt, preset_style, init_image_id)
+        with span("cache_lookup"):
+            return cache_key, await asyncio.to_thread(result_cache.get, cache_key)
+
+    async def generate(reference, prompt, cached):
+        if cached[1] is not None:
+            return None
+        init_image_id, _ = reference
+        return await generate_image_leonardo(prompt, init_image_id, preset_style, strategy=strategy, job=job)
+
+    async def results(reference, generate, cached):
+        _, overlay = reference
+        cache_key, cached_images = cached
+        if cached_images is not None:
+            if on_cache_hit:
+                on_cache_hit()
+            for index, img in enumerate(cached_images):
+                if on_image:
+                    await asyncio.to_thread(on_image, index, img)
+            return cached_images
+
+        finished = {"downloading": 0, "compositing": 0}
+        report_progress(job, "downloading", done=0, total=len(generate))
+
+        async def fetch(index, url):
+            with span("download", image=index):
+                img = await client.download_image(url)
+            finished["downloading"] += 1
+            report_progress(job, "downloading", done=finished["downloading"], total=len(generate))
+            if overlay is not None:
+                with span("composite", image=index):
+                    img = await asyncio.to_thread(apply_overlay, img, overlay)
+                finished["compositing"] += 1
+                report_progress(job, "compositing", done=finished["compositing"], total=len(generate))
+            # Hand each result over as soon as it is ready
+            if on_image:
+                await asyncio.to_thread(on_image, index, img)
+            return img
+
+        # Download, decode and composite all four results concurrently
+        images = await asyncio.gather(*(fetch(i, url) for i, url in enumerate(generate)))
+        if cache_key is not None:
+            await asyncio.to_thread(result_cache.put, cache_key, images)
+        return images
+
+    # Upload and translation don't depend on each other, so they run side by side
+    outputs = await run_graph([
+        Stage("reference", reference),
+        Stage("prompt", prompt),
+        Stage("cached", cached, deps=("reference", "prompt")),
+        Stage("generate", generate, deps=("reference", "prompt", "cached")),
+        Stage("results", results, deps=("reference", "generate", "cached")),
+    ])
+    return outputs["results"]
+
+
+async def run_generation_job(job, username, complete_text, strategy=None, on_cache_hit=None):
+    # Results go to the artifact store as they land; the job and session only keep handles
+    artifact_store = get_artifact_store()
+    set_span_tags(job_id=job.id, username=username)
+
+    def store_image(index, img):
+        with span("store", image=index):
+            job.add_partial_result(index, artifact_store.put(job.id, index, img))
+
+    with span("job"):
+        await generate_images_async(username, complete_text, on_image=store_image, strategy=strategy,
+                                    on_cache_hit=on_cache_hit, job=job)
+    return [job.partial_results[i] for i in sorted(job.partial_results)]
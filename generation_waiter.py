@@ -0,0 +1,170 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from leonardo_client import LeonardoAPIError
+
+# Starting guesses (seconds) until we have observed real jobs for a phase; can be
+# overridden with GENERATION_EXPECTED_DURATIONS (e.g. for the fakes)
+DEFAULT_EXPECTED_DURATIONS = {"initial": 20.0, "final": 45.0}
+
+
+class GenerationTimeout(Exception):
+    pass
+
+
+class DurationStats:
+    # Exponentially weighted average of how long each phase actually takes
+    def __init__(self, alpha=0.3, defaults=None):
+        self.alpha = alpha
+        self.expected = dict(DEFAULT_EXPECTED_DURATIONS if defaults is None else defaults)
+        self.lock = threading.Lock()
+
+    def get(self, phase):
+        with self.lock:
+            return self.expected.get(phase, 30.0)
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            previous = self.expected.get(phase)
+            if previous is None:
+                self.expected[phase] = seconds
+            else:
+                self.expected[phase] = (1 - self.alpha) * previous + self.alpha * seconds
+
+
+class CallbackReceiver:
+    # Receives Leonardo webhook pushes and wakes up whoever waits on that generation
+    def __init__(self, host="0.0.0.0", port=8502, path="/leonardo-callback", token=None):
+        self.path = path
+        self.token = token
+        # Only generations someone is waiting on, so late or foreign pushes don't pile up
+        self.events = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.thread = None
+
+    def _handler_class(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != receiver.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if receiver.token and self.headers.get("Authorization") != f"Bearer {receiver.token}":
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                    generation_id = body["data"]["object"]["id"]
+                except (ValueError, KeyError, TypeError):
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                receiver.notify(generation_id)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def watch(self, generation_id):
+        with self.lock:
+            return self.events.setdefault(generation_id, threading.Event())
+
+    def notify(self, generation_id):
+        with self.lock:
+            event = self.events.get(generation_id)
+        if event is not None:
+            event.set()
+
+    def wait(self, generation_id, timeout):
+        event = self.watch(generation_id)
+        if event.wait(timeout):
+            # Clear so an early push for a not-yet-visible result doesn't turn into a busy loop
+            event.clear()
+            return True
+        return False
+
+    def forget(self, generation_id):
+        with self.lock:
+            self.events.pop(generation_id, None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class GenerationWaiter:
+    def __init__(self, client, stats=None, receiver=None, min_interval=1.0, max_interval=5.0,
+                 backoff=1.5, deadline=300.0):
+        self.client = client
+        self.stats = stats or DurationStats()
+        self.receiver = receiver
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.deadline = deadline
+
+    def next_delay(self, elapsed, expected, previous_delay):
+        # Before the expected finish, close in on it by halving the remaining time;
+        # past it, back off exponentially so a slow job doesn't burn our rate limit.
+        # Either way a finished job is seen within max_interval, however
+        # pessimistic the prior for its phase is.
+        if elapsed < expected:
+            delay = (expected - elapsed) / 2
+        elif previous_delay is None:
+            delay = self.min_interval
+        else:
+            delay = previous_delay * self.backoff
+        return min(self.max_interval, max(self.min_interval, delay))
+
+    async def _sleep(self, generation_id, delay):
+        if self.receiver is None:
+            await asyncio.sleep(delay)
+            return False
+        return await asyncio.to_thread(self.receiver.wait, generation_id, delay)
+
+    async def wait(self, generation_id, phase, deadline=None):
+        deadline = self.deadline if deadline is None else deadline
+        expected = self.stats.get(phase)
+        start = time.monotonic()
+        delay = None
+        if self.receiver is not None:
+            # Registered before the first poll, so a push that lands in between isn't dropped
+            self.receiver.watch(generation_id)
+        try:
+            while True:
+                elapsed = time.monotonic() - start
+                remaining = deadline - elapsed
+                if remaining <= 0:
+                    raise GenerationTimeout(
+                        f"Generation {generation_id} ({phase}) did not complete within {deadline:g}s"
+                    )
+                delay = min(self.next_delay(elapsed, expected, delay), remaining)
+                await self._sleep(generation_id, delay)
+
+                generation_data = await self.client.get_generation(generation_id, deadline=start + deadline)
+                if not generation_data:
+                    continue
+                if generation_data["status"] == "COMPLETE":
+                    self.stats.observe(phase, time.monotonic() - start)
+                    return generation_data
+                if generation_data["status"] == "FAILED":
+                    raise LeonardoAPIError(f"Generation {generation_id} ({phase}) failed")
+        finally:
+            if self.receiver is not None:
+                self.receiver.forget(generation_id)
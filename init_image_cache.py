@@ -0,0 +1,52 @@
+import hashlib
+import threading
+import time
+
+from locked_json import locked_json, load_json
+
+DEFAULT_CACHE_PATH = "init_image_cache.json"
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+class InitImageCache:
+    # Maps (username, photo content hash) -> Leonardo init image id, persisted to a JSON file.
+    # The app, worker.py processes and warm_init_images.py all write to the same
+    # file, so writes merge into what is on disk under an flock, and a miss
+    # re-reads the file before anyone uploads again.
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = load_json(path)
+
+    @staticmethod
+    def key(username, image_bytes):
+        return f"{username}:{hashlib.sha256(image_bytes).hexdigest()}"
+
+    def _valid(self, entry):
+        return entry is not None and time.time() - entry["uploaded_at"] <= self.ttl
+
+    def get(self, username, image_bytes):
+        key = self.key(username, image_bytes)
+        with self.lock:
+            entry = self.data.get(key)
+        if not self._valid(entry):
+            # Another process may have uploaded this photo since we last read the file
+            with locked_json(self.path, self.lock) as data:
+                entry = data.get(key)
+            self.data = data
+        if not self._valid(entry):
+            return None
+        return entry["image_id"]
+
+    def set(self, username, image_bytes, image_id):
+        with locked_json(self.path, self.lock) as data:
+            data[self.key(username, image_bytes)] = {"image_id": image_id, "uploaded_at": time.time()}
+        self.data = data
+
+    async def get_or_upload(self, username, image_bytes, upload):
+        image_id = self.get(username, image_bytes)
+        if image_id is None:
+            image_id = await upload(image_bytes)
+            self.set(username, image_bytes, image_id)
+        return image_id
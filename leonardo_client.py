@@ -0,0 +1,178 @@
+import asyncio
+import json
+import random
+import time
+from io import BytesIO
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+LEONARDO_API_BASE = "https://cloud.leonardo.ai/api/rest/v1"
+
+# Statuses that are safe to retry. 5xx on a POST is only retried when the
+# caller says so, since a generation submit may already have been accepted.
+RATE_LIMIT_STATUS = 429
+SERVER_ERROR_STATUSES = {500, 502, 503, 504}
+
+
+class LeonardoAPIError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LeonardoClient:
+    def __init__(self, api_key, base_url=LEONARDO_API_BASE, connect_timeout=5, read_timeout=30,
+                 max_retries=4, backoff_factor=1.0, max_backoff=30, pool_size=32,
+                 rate_limiter=None, max_rate_limit_retries=20):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        # Optional rate_limiter.RateLimiter; calls wait for a token from their bucket
+        # ("submit", "poll" or "upload") and a 429 pauses the whole bucket
+        self.rate_limiter = rate_limiter
+        self.max_rate_limit_retries = max_rate_limit_retries
+
+        # One pooled keep-alive session shared by every caller in the process
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _api_headers(self):
+        return {
+            "accept": "application/json",
+            "content-type": "application/json",
+            "authorization": f"Bearer {self.api_key}",
+        }
+
+    def _backoff_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                # Honored as sent; callers with a deadline give up rather than wait past it
+                try:
+                    return max(float(retry_after), 0.0)
+                except ValueError:
+                    pass
+        delay = self.backoff_factor * (2 ** attempt)
+        return min(delay, self.max_backoff) * random.uniform(0.5, 1.0)
+
+    def _send(self, method, url, retry_server_errors=True, bucket=None, deadline=None, **kwargs):
+        # deadline is a time.monotonic() value: a retry that would wait past it
+        # isn't made, and the last response (or connection error) goes back instead
+        kwargs.setdefault("timeout", self.timeout)
+        limiter = self.rate_limiter if bucket is not None else None
+        attempt = 0
+        rate_limited = 0
+
+        def too_late(delay):
+            return deadline is not None and time.monotonic() + delay > deadline
+
+        while True:
+            if limiter is not None:
+                limiter.acquire(bucket)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self._backoff_delay(attempt)
+                if not retry_server_errors or attempt >= self.max_retries or too_late(delay):
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if limiter is not None and response.status_code == RATE_LIMIT_STATUS:
+                # Queue behind the governor instead of failing: everyone on this bucket
+                # waits out Retry-After, and it doesn't use up the retries for real errors
+                if rate_limited >= self.max_rate_limit_retries:
+                    return response
+                delay = self._backoff_delay(rate_limited, response)
+                limiter.pause(bucket, delay)
+                if too_late(delay):
+                    return response
+                # Hand the connection back to the pool before trying again
+                response.close()
+                rate_limited += 1
+                continue
+
+            retryable = response.status_code == RATE_LIMIT_STATUS or (
+                retry_server_errors and response.status_code in SERVER_ERROR_STATUSES
+            )
+            if not retryable or attempt >= self.max_retries:
+                return response
+            delay = self._backoff_delay(attempt, response)
+            if too_late(delay):
+                return response
+            time.sleep(delay)
+            response.close()
+            attempt += 1
+
+    def _api(self, method, path, retry_server_errors=True, bucket=None, **kwargs):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        return self._send(method, url, retry_server_errors=retry_server_errors, bucket=bucket,
+                          headers=self._api_headers(), **kwargs)
+
+    # Blocking calls, run off the event loop by the async wrappers below
+
+    def create_generation_sync(self, payload):
+        # Returns the sdGenerationJob: generationId plus apiCreditCost
+        response = self._api("POST", "generations", retry_server_errors=False, bucket="submit", json=payload)
+        if response.status_code != 200:
+            raise LeonardoAPIError(f"Failed to create generation: {response.text}", response.status_code)
+        return response.json()["sdGenerationJob"]
+
+    def get_generation_sync(self, generation_id, deadline=None):
+        # None while Leonardo is overloaded (429 or 5xx after retries), so the caller polls
+        # again; any other error, like a bad key or an unknown id, won't go away by polling
+        response = self._api("GET", f"generations/{generation_id}", bucket="poll", deadline=deadline)
+        if response.status_code == RATE_LIMIT_STATUS or response.status_code in SERVER_ERROR_STATUSES:
+            return None
+        if response.status_code != 200:
+            raise LeonardoAPIError(f"Failed to get generation {generation_id}: {response.text}", response.status_code)
+        return response.json()["generations_by_pk"]
+
+    def upload_init_image_sync(self, image_file, extension="jpg"):
+        response = self._api("POST", "init-image", bucket="upload", json={"extension": extension})
+        if response.status_code != 200:
+            raise LeonardoAPIError(f"Failed to get presigned URL: {response.text}", response.status_code)
+
+        # Read the body up front so a retried upload doesn't send an exhausted stream
+        if hasattr(image_file, "read"):
+            image_file = image_file.read()
+
+        upload_data = response.json()["uploadInitImage"]
+        fields = json.loads(upload_data["fields"])
+        files = {"file": (f"image.{extension}", image_file, f"image/{'jpeg' if extension == 'jpg' else extension}")}
+        response = self._send("POST", upload_data["url"], bucket="upload", data=fields, files=files)
+        if response.status_code != 204:
+            raise LeonardoAPIError(f"Failed to upload image: {response.status_code}", response.status_code)
+        return upload_data["id"]
+
+    def download_image_sync(self, url):
+        # Decoded here, on the calling thread, so the four results decode side by side
+        response = self._send("GET", url)
+        if response.status_code != 200:
+            raise LeonardoAPIError(f"Failed to download image: {response.status_code}", response.status_code)
+        image = Image.open(BytesIO(response.content))
+        image.load()
+        return image
+
+    async def create_generation(self, payload):
+        return await asyncio.to_thread(self.create_generation_sync, payload)
+
+    async def get_generation(self, generation_id, deadline=None):
+        return await asyncio.to_thread(self.get_generation_sync, generation_id, deadline)
+
+    async def upload_init_image(self, image_file, extension="jpg"):
+        return await asyncio.to_thread(self.upload_init_image_sync, image_file, extension)
+
+    async def download_image(self, url):
+        return await asyncio.to_thread(self.download_image_sync, url)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,39 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+# Read-modify-write of a JSON file shared by several processes (the app,
+# worker.py, the CLI tools). Each file is guarded by an flock on a sibling
+# .lock file plus the caller's threading lock, and is replaced atomically.
+
+
+def load_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def locked_json(path, thread_lock):
+    # Yields the file's current contents; changes made inside the block are
+    # written back when it exits normally, and nothing is written otherwise
+    with thread_lock, open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            data = load_json(path)
+            before = json.dumps(data, ensure_ascii=False)
+            yield data
+            if json.dumps(data, ensure_ascii=False) != before:
+                save_json(path, data)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import logging
+import smtplib
+import threading
+import time
+import uuid
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+SENT = "sent"
+FAILED = "failed"
+
+# Errors worth retrying besides 4xx replies: dropped or refused connections and
+# timeouts. Anything else (a 5xx, no STARTTLS support, bad credentials) won't fix itself.
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+def _is_transient(error):
+    # SMTPConnectError is a response too, so a 4xx greeting is retried and a 5xx isn't
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class MailQueue:
+    # Background sender that keeps one authenticated SMTP connection open,
+    # drains queued messages in batches and retries transient failures.
+    # Statuses of sent or failed messages are kept for keep_finished seconds.
+    def __init__(self, host, port, username, password, use_tls=True, batch_size=10, max_retries=5,
+                 retry_delay=5.0, idle_timeout=60.0, timeout=30, keep_finished=3600):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.keep_finished = keep_finished
+        self.pending = []
+        self.sequence = itertools.count()
+        self.statuses = {}
+        self.condition = threading.Condition()
+        self.server = None
+        self.thread = threading.Thread(target=self._worker, name="mail-queue", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, sender, recipients, message):
+        message_id = uuid.uuid4().hex
+        with self.condition:
+            self._prune()
+            self.statuses[message_id] = {"status": QUEUED, "attempts": 0, "error": None, "updated": time.time()}
+            heapq.heappush(self.pending, (time.monotonic(), next(self.sequence), message_id, sender, list(recipients), message))
+            self.condition.notify()
+        return message_id
+
+    def status(self, message_id):
+        with self.condition:
+            status = self.statuses.get(message_id)
+            return dict(status) if status else None
+
+    def _set_status(self, message_id, **fields):
+        with self.condition:
+            self.statuses[message_id].update(fields, updated=time.time())
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_finished
+        for message_id in [m for m, s in self.statuses.items() if s["status"] in (SENT, FAILED) and s["updated"] < cutoff]:
+            del self.statuses[message_id]
+
+    def _next_batch(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.pending and self.pending[0][0] <= now:
+                    batch = []
+                    while self.pending and self.pending[0][0] <= now and len(batch) < self.batch_size:
+                        batch.append(heapq.heappop(self.pending))
+                    return batch
+                wait = self.pending[0][0] - now if self.pending else self.idle_timeout
+                if not self.condition.wait(timeout=wait) and not self.pending:
+                    # Nothing to send for a while, let the SMTP connection go
+                    self._disconnect()
+
+    def _connect(self):
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] == 250:
+                    return self.server
+            except smtplib.SMTPException:
+                pass
+            self._disconnect()
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        self.server = server
+        return server
+
+    def _disconnect(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+    def _worker(self):
+        while True:
+            for _, _, message_id, sender, recipients, message in self._next_batch():
+                attempts = self.statuses[message_id]["attempts"] + 1
+                try:
+                    with span("email", message_id=message_id, attempt=attempts):
+                        self._connect().sendmail(sender, recipients, message)
+                except Exception as e:
+                    if not isinstance(e, smtplib.SMTPResponseException):
+                        self._disconnect()
+                    if _is_transient(e) and attempts <= self.max_retries:
+                        self._set_status(message_id, attempts=attempts, error=str(e))
+                        with self.condition:
+                            ready_at = time.monotonic() + self.retry_delay * (2 ** (attempts - 1))
+                            heapq.heappush(self.pending, (ready_at, next(self.sequence), message_id, sender, recipients, message))
+                    else:
+                        logger.error("Giving up on email %s after %d attempts: %s", message_id, attempts, e)
+                        self._set_status(message_id, status=FAILED, attempts=attempts, error=str(e))
+                else:
+                    self._set_status(message_id, status=SENT, attempts=attempts, error=None)
@@ -0,0 +1,222 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+span_logger = logging.getLogger("dream.spans")
+
+# Histogram bucket upper bounds (seconds) for stage latencies
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# Tags (job_id, username) attached to every span started in the current job
+span_tags = contextvars.ContextVar("span_tags", default={})
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class StrategyStats:
+    # Latency and API credit cost per generation strategy, so we can pick the
+    # cheapest one that still looks good.
+    def __init__(self, window=500):
+        self.window = window
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, strategy):
+        return self.stats.setdefault(strategy, {
+            "count": 0,
+            "failures": 0,
+            "credits": 0,
+            "durations": deque(maxlen=self.window),
+        })
+
+    def record(self, strategy, seconds, credits=0, ok=True):
+        with self.lock:
+            entry = self._entry(strategy)
+            if ok:
+                entry["count"] += 1
+                entry["credits"] += credits or 0
+                entry["durations"].append(seconds)
+            else:
+                entry["failures"] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                strategy: {
+                    "count": entry["count"],
+                    "failures": entry["failures"],
+                    "mean_seconds": sum(entry["durations"]) / len(entry["durations"]) if entry["durations"] else None,
+                    "p95_seconds": percentile(entry["durations"], 0.95),
+                    "mean_credits": entry["credits"] / entry["count"] if entry["count"] else None,
+                }
+                for strategy, entry in self.stats.items()
+            }
+
+
+class StageMetrics:
+    # Latency histograms and error counts per pipeline stage, plus gauges
+    # that are read when metrics are exported.
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=500):
+        self.buckets = tuple(buckets)
+        self.window = window
+        self.stages = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, stage):
+        return self.stages.setdefault(stage, {
+            "buckets": [0] * (len(self.buckets) + 1),
+            "sum": 0.0,
+            "count": 0,
+            "errors": 0,
+            "durations": deque(maxlen=self.window),
+        })
+
+    def record(self, stage, seconds, ok=True):
+        with self.lock:
+            entry = self._entry(stage)
+            entry["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+            entry["sum"] += seconds
+            entry["count"] += 1
+            entry["durations"].append(seconds)
+            if not ok:
+                entry["errors"] += 1
+
+    def set_gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def gauge_values(self):
+        values = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                values[name] = fn()
+            except Exception:
+                values[name] = None
+        return values
+
+    def summary(self):
+        with self.lock:
+            return {
+                stage: {
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "mean_seconds": entry["sum"] / entry["count"] if entry["count"] else None,
+                    "p50_seconds": percentile(entry["durations"], 0.5),
+                    "p95_seconds": percentile(entry["durations"], 0.95),
+                    # Non-cumulative counts per bucket, the last one is everything above the top bound
+                    "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], entry["buckets"])),
+                }
+                for stage, entry in self.stages.items()
+            }
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP dream_stage_seconds Time spent in each generation pipeline stage.",
+            "# TYPE dream_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, entry in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], entry["buckets"]):
+                    cumulative += count
+                    lines.append(f'dream_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'dream_stage_seconds_sum{{stage="{stage}"}} {entry["sum"]:.6f}')
+                lines.append(f'dream_stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+            lines.append("# HELP dream_stage_errors_total Stage runs that raised an error.")
+            lines.append("# TYPE dream_stage_errors_total counter")
+            for stage, entry in sorted(self.stages.items()):
+                lines.append(f'dream_stage_errors_total{{stage="{stage}"}} {entry["errors"]}')
+        for name, value in sorted(self.gauge_values().items()):
+            if value is not None:
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+strategy_stats = StrategyStats()
+stage_metrics = StageMetrics()
+
+
+def set_span_tags(**tags):
+    # Tag all spans in the current context (and the tasks/threads it starts)
+    span_tags.set({**span_tags.get(), **tags})
+
+
+@contextmanager
+def span(stage, **tags):
+    # Times a pipeline stage, records it in stage_metrics and logs it as one JSON line
+    tags = {**span_tags.get(), **tags}
+    start = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        seconds = time.monotonic() - start
+        stage_metrics.record(stage, seconds, ok=error is None)
+        record = {"event": "span", "stage": stage, "seconds": round(seconds, 4), "ok": error is None, **tags}
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+        span_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+class MetricsServer:
+    # Serves stage_metrics as Prometheus text on /metrics and as JSON on /metrics.json
+    def __init__(self, host="0.0.0.0", port=9108, metrics=None, stats=None):
+        self.metrics = metrics or stage_metrics
+        self.stats = stats or strategy_stats
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.thread = None
+
+    def _handler_class(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = exporter.metrics.prometheus_text().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps({
+                        "stages": exporter.metrics.summary(),
+                        "gauges": exporter.metrics.gauge_values(),
+                        "strategies": exporter.stats.summary(),
+                    }).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
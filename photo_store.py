@@ -0,0 +1,155 @@
+import argparse
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from compositing import render_overlay
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # face detection is optional, we fall back to a portrait heuristic
+    cv2 = None
+
+# Canonical reference photos: orientation fixed, square crop around the face,
+# sized for the character-reference controlnet and encoded once, plus the
+# small thumbnail that gets overlaid on the results.
+
+SOURCE_DIR = "images"
+STORE_DIR = "photo_store"
+REFERENCE_SIZE = 768
+REFERENCE_QUALITY = 85
+THUMBNAIL_SIZE = (300, 300)
+
+
+def _face_center(image):
+    if cv2 is None:
+        return None
+    gray = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2GRAY)
+    cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60))
+    if len(faces) == 0:
+        return None
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+    return x + w / 2, y + h / 2
+
+
+def _square_crop_box(image):
+    width, height = image.size
+    side = min(width, height)
+    center = _face_center(image)
+    if center is None:
+        # Guest photos are mostly portraits with the face in the upper part of the frame
+        center = (width / 2, height / 3 if height > width else height / 2)
+    left = min(max(center[0] - side / 2, 0), width - side)
+    top = min(max(center[1] - side / 2, 0), height - side)
+    return int(left), int(top), int(left) + side, int(top) + side
+
+
+def preprocess_photo(source_path):
+    image = ImageOps.exif_transpose(Image.open(source_path)).convert("RGB")
+
+    reference = image.crop(_square_crop_box(image))
+    if reference.width > REFERENCE_SIZE:  # never upscale, it only adds bytes
+        reference = reference.resize((REFERENCE_SIZE, REFERENCE_SIZE), Image.LANCZOS)
+    reference_bytes = BytesIO()
+    reference.save(reference_bytes, format="JPEG", quality=REFERENCE_QUALITY, optimize=True)
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+    thumbnail_bytes = BytesIO()
+    thumbnail.save(thumbnail_bytes, format="PNG", optimize=True)
+
+    return reference_bytes.getvalue(), thumbnail_bytes.getvalue()
+
+
+class PhotoStore:
+    def __init__(self, source_dir=SOURCE_DIR, store_dir=STORE_DIR):
+        self.source_dir = source_dir
+        self.store_dir = store_dir
+        self.thumbnails = {}
+        self.overlays = {}
+        self.lock = threading.Lock()
+
+    def source_path(self, filename):
+        return os.path.join(self.source_dir, filename)
+
+    def reference_path(self, filename):
+        return os.path.join(self.store_dir, os.path.splitext(filename)[0] + ".jpg")
+
+    def thumbnail_path(self, filename):
+        return os.path.join(self.store_dir, os.path.splitext(filename)[0] + ".thumb.png")
+
+    def is_current(self, filename):
+        source_mtime = os.path.getmtime(self.source_path(filename))
+        return all(
+            os.path.exists(path) and os.path.getmtime(path) >= source_mtime
+            for path in (self.reference_path(filename), self.thumbnail_path(filename))
+        )
+
+    def build(self, filename):
+        reference_bytes, thumbnail_bytes = preprocess_photo(self.source_path(filename))
+        os.makedirs(self.store_dir, exist_ok=True)
+        for path, data in ((self.reference_path(filename), reference_bytes), (self.thumbnail_path(filename), thumbnail_bytes)):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return reference_bytes
+
+    def ensure(self, filename):
+        if not self.is_current(filename):
+            self.build(filename)
+
+    def reference_bytes(self, filename):
+        # Falls back to preprocessing on demand if the offline stage wasn't run
+        self.ensure(filename)
+        with open(self.reference_path(filename), "rb") as f:
+            return f.read()
+
+    def thumbnail(self, filename):
+        with self.lock:
+            thumbnail = self.thumbnails.get(filename)
+        if thumbnail is None:
+            self.ensure(filename)
+            thumbnail = Image.open(self.thumbnail_path(filename))
+            thumbnail.load()
+            with self.lock:
+                self.thumbnails[filename] = thumbnail
+        return thumbnail
+
+    def overlay(self, filename):
+        # Bordered RGBA thumbnail, rendered once and shared read-only by all composites
+        with self.lock:
+            overlay = self.overlays.get(filename)
+        if overlay is None:
+            overlay = render_overlay(self.thumbnail(filename))
+            with self.lock:
+                self.overlays[filename] = overlay
+        return overlay
+
+
+def _build_one(args):
+    source_dir, store_dir, filename, force = args
+    store = PhotoStore(source_dir, store_dir)
+    if not force and store.is_current(filename):
+        return filename, "current"
+    store.build(filename)
+    return filename, "built"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess guest photos into the reference photo store")
+    parser.add_argument("--source", default=SOURCE_DIR)
+    parser.add_argument("--store", default=STORE_DIR)
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    filenames = sorted(f for f in os.listdir(args.source) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for filename, outcome in executor.map(_build_one, [(args.source, args.store, f, args.force) for f in filenames]):
+            print(f"{outcome:8} {filename}")
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Stage:
+    # fn is an async callable receiving the results of its dependencies as keyword arguments
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+
+
+async def run_graph(stages):
+    # Runs every stage as soon as its dependencies are done, so independent
+    # stages overlap. The first failure cancels everything still running.
+    by_name = {stage.name: stage for stage in stages}
+    tasks = {}
+
+    def task_for(name):
+        if name not in tasks:
+            stage = by_name[name]
+            tasks[name] = asyncio.ensure_future(run_stage(stage))
+        return tasks[name]
+
+    async def run_stage(stage):
+        dep_results = await asyncio.gather(*(task_for(dep) for dep in stage.deps))
+        return await stage.fn(**dict(zip(stage.deps, dep_results)))
+
+    for stage in stages:
+        task_for(stage.name)
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return {name: task.result() for name, task in tasks.items()}
+
+
+class Prefetcher:
+    # Starts pipeline inputs (reference upload, translation) speculatively,
+    # before the job that needs them exists. The job claims a prefetched
+    # result with take(), so each one is used at most once.
+    def __init__(self, max_workers=4, max_entries=256):
+        self.max_entries = max_entries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self.lock:
+            if len(self.futures) > self.max_entries:
+                # Drop finished results nobody claimed (e.g. a dream that was edited afterwards)
+                for stale in [k for k, f in self.futures.items() if f.done()]:
+                    del self.futures[stale]
+            future = self.futures.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self.executor.submit(fn, *args)
+                self.futures[key] = future
+            return future
+
+    def take(self, key):
+        with self.lock:
+            return self.futures.pop(key, None)
+
+    async def claim(self, key, fn, *args):
+        # Await the prefetched result if there is one, otherwise compute it now
+        future = self.take(key)
+        if future is not None:
+            try:
+                return await asyncio.wrap_future(future)
+            except Exception:
+                pass
+        return await fn(*args)
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from sqlite_store import SQLiteStore
+
+# Client-side governor for the Leonardo API: one token bucket per kind of call,
+# so a burst of guests queues up here instead of turning into 429s and failed
+# generations. A 429's Retry-After pauses the whole bucket, not just the caller
+# that got it. With SQLiteBucketStore the buckets are shared by every process on
+# the host (the app and worker.py processes), like the job queue.
+
+# Bucket name -> (tokens per second, burst size)
+DEFAULT_LIMITS = {
+    "submit": (1.0, 5),   # generation submissions
+    "poll": (5.0, 10),    # generation status polls
+    "upload": (1.0, 5),   # init image presign and upload
+}
+
+
+def refill(tokens, updated, now, rate, capacity):
+    return min(capacity, tokens + max(now - updated, 0) * rate)
+
+
+def take_token(tokens, blocked_until, now, rate):
+    # Returns the tokens left and how long to wait (0 when a token was taken)
+    if now < blocked_until:
+        return tokens, blocked_until - now
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    # Bucket state shared by the threads of one process
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _state(self, name, capacity, now, rate):
+        tokens, updated, blocked_until = self.buckets.get(name, (capacity, now, 0.0))
+        return refill(tokens, updated, now, rate, capacity), blocked_until
+
+    def take(self, name, rate, capacity):
+        with self.lock:
+            now = time.time()
+            tokens, blocked_until = self._state(name, capacity, now, rate)
+            tokens, wait = take_token(tokens, blocked_until, now, rate)
+            self.buckets[name] = (tokens, now, blocked_until)
+            return wait
+
+    def pause(self, name, seconds, rate, capacity):
+        # Empty the bucket and start refilling only when the pause ends, so
+        # callers trickle back in afterwards instead of bursting
+        with self.lock:
+            now = time.time()
+            _, blocked_until = self._state(name, capacity, now, rate)
+            self.buckets[name] = (0.0, now + seconds, max(blocked_until, now + seconds))
+
+    def level(self, name, rate, capacity):
+        with self.lock:
+            now = time.time()
+            tokens, blocked_until = self._state(name, capacity, now, rate)
+            return tokens, now < blocked_until
+
+
+class SQLiteBucketStore(SQLiteStore):
+    # Bucket state in a WAL-mode SQLite file, shared by every process that opens it
+    def __init__(self, path="rate_limits.db"):
+        super().__init__(path)
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " name TEXT PRIMARY KEY,"
+                " tokens REAL NOT NULL,"
+                " updated REAL NOT NULL,"
+                " blocked_until REAL NOT NULL DEFAULT 0)"
+            )
+
+    def _state(self, conn, name, capacity, now, rate):
+        row = conn.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity, 0.0
+        return refill(row[0], row[1], now, rate, capacity), row[2]
+
+    def _store(self, conn, name, tokens, now, blocked_until):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (name, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)",
+            (name, tokens, now, blocked_until),
+        )
+
+    def take(self, name, rate, capacity):
+        with self.connection() as conn:
+            now = time.time()
+            tokens, blocked_until = self._state(conn, name, capacity, now, rate)
+            tokens, wait = take_token(tokens, blocked_until, now, rate)
+            self._store(conn, name, tokens, now, blocked_until)
+            return wait
+
+    def pause(self, name, seconds, rate, capacity):
+        with self.connection() as conn:
+            now = time.time()
+            _, blocked_until = self._state(conn, name, capacity, now, rate)
+            self._store(conn, name, 0.0, now + seconds, max(blocked_until, now + seconds))
+
+    def level(self, name, rate, capacity):
+        # Read-only, so no write lock
+        now = time.time()
+        tokens, blocked_until = self._state(self._connect(), name, capacity, now, rate)
+        return tokens, now < blocked_until
+
+
+class RateLimiter:
+    def __init__(self, limits=None, store=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        for name, (rate, capacity) in (limits or {}).items():
+            self.limits[name] = (float(rate), capacity)
+        self.store = store or MemoryBucketStore()
+
+    def acquire(self, name):
+        # Blocks until the bucket has a token; returns the seconds spent waiting
+        rate, capacity = self.limits[name]
+        waited = 0.0
+        while True:
+            wait = self.store.take(name, rate, capacity)
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, name, seconds):
+        rate, capacity = self.limits[name]
+        self.store.pause(name, seconds, rate, capacity)
+
+    def utilisation(self, name):
+        # 0 when the full burst is available, 1 when the bucket is empty or paused
+        rate, capacity = self.limits[name]
+        tokens, blocked = self.store.level(name, rate, capacity)
+        return 1.0 if blocked else round(1 - tokens / capacity, 3)
+
+    def register_gauges(self, metrics):
+        for name in self.limits:
+            metrics.set_gauge(f"dream_leonardo_{name}_utilisation", lambda name=name: self.utilisation(name))
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import shutil
+from io import BytesIO
+
+from PIL import Image
+
+from translation import normalize_text
+
+
+class ResultCache:
+    # Finished (composited) results keyed by what determines them, so a
+    # duplicate or retried dream is served from disk instead of a new paid
+    # generation. Trimmed to max_bytes, least recently used first.
+    def __init__(self, root="result_cache", max_bytes=1024 ** 3, quality=95):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.quality = quality
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(username, prompt, preset_style, init_image_id):
+        raw = json.dumps([username, normalize_text(prompt).lower(), preset_style, init_image_id], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _dir(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        path = self._dir(key)
+        try:
+            names = sorted(os.listdir(path), key=lambda name: int(name.split(".")[0]))
+        except FileNotFoundError:
+            return None
+        if not names:
+            return None
+        images = []
+        for name in names:
+            img = Image.open(os.path.join(path, name))
+            img.load()
+            images.append(img)
+        os.utime(path)  # mark as recently used
+        return images
+
+    def put(self, key, images):
+        tmp_path = f"{self._dir(key)}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for index, img in enumerate(images):
+            buffer = BytesIO()
+            img.convert("RGB").save(buffer, format="JPEG", quality=self.quality)
+            with open(os.path.join(tmp_path, f"{index}.jpg"), "wb") as f:
+                f.write(buffer.getvalue())
+        shutil.rmtree(self._dir(key), ignore_errors=True)
+        os.replace(tmp_path, self._dir(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                entries.append((entry.stat().st_mtime, entry.path, size))
+            except FileNotFoundError:
+                # Already removed by an evict running in another thread or process
+                continue
+            total += size
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
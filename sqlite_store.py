@@ -0,0 +1,35 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Base for the stores kept in one WAL-mode SQLite file shared by several
+# processes (the app, worker.py, the CLI tools): rate limits, the job queue
+# and per-user counters. Each thread gets its own connection.
+
+
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def connection(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write
+        # inside the block is atomic across processes
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
@@ -1,59 +1,163 @@
 import streamlit as st
-import os
 from dotenv import load_dotenv
 import time
-import random
-from PIL import Image, ImageDraw
-import requests
-from io import BytesIO
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.header import Header
-from deep_translator import GoogleTranslator
-import json
-from user_data_storage import user_storage
-import asyncio
-import traceback
+import logging
+from user_data_storage import user_storage, user_directory
+from generation_jobs import SQLiteJobQueue, QUEUED, DONE, FAILED
+from metrics import strategy_stats, stage_metrics, span
+# PIL, requests, smtplib and the email package are imported where they are first
+# used, so the login page of a cold server process doesn't wait for them
 
 #
 
-# if user_data is not in st.session_state, add it with default values
-if "user_data" not in st.session_state:
-    st.session_state.user_data = {}
-
 if "processed_images" not in st.session_state:
     st.session_state.processed_images = None
 
+
+# Streamlit scales any image wider than this down on every run that shows it
+LOGO_MAX_WIDTH = 1460
+
+
+# The logo decoded and scaled once per server process, so reruns hand Streamlit
+# PNG bytes it can pass through instead of re-decoding and resizing the original
+@st.cache_resource
+def get_logo():
+    from io import BytesIO
+    from PIL import Image
+
+    logo = Image.open("main_logo.png")
+    if logo.width > LOGO_MAX_WIDTH:
+        logo = logo.resize((LOGO_MAX_WIDTH, int(logo.height * LOGO_MAX_WIDTH / logo.width)), Image.BILINEAR)
+    buffer = BytesIO()
+    logo.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
 # col1, col2, col3 = st.columns([1,2,1])
 # with col2:
-st.logo("main_logo.png")
+st.logo(get_logo())
 
 # Load environment variables #
 load_dotenv()
 
-# Leonardo AI API configuration
-LEONARDO_API_KEY = st.secrets["LEONARDO_API_KEY"]
-LEONARDO_API_URL = "https://cloud.leonardo.ai/api/rest/v1/generations"
+
+# The generation pipeline (Leonardo, translation, photos, artifacts) is imported
+# and configured on first use, once per server process, and reads its own settings
+@st.cache_resource
+def get_pipeline():
+    import generation_pipeline
+    # With external workers this process never waits on a generation, so worker.py owns the callback port
+    generation_pipeline.configure(st.secrets, callbacks=GENERATION_WORKER != "external", directory=user_directory)
+    return generation_pipeline
+
+
+def get_artifact_store():
+    return get_pipeline().get_artifact_store()
+
+
+# Cap on generations in flight at once across all sessions; the rest queue fairly
+GENERATION_MAX_CONCURRENT = st.secrets.get("GENERATION_MAX_CONCURRENT", 4)
+# "inline" runs generations on threads in this process, "external" leaves them to worker.py
+GENERATION_WORKER = st.secrets.get("GENERATION_WORKER", "inline")
+JOB_QUEUE_PATH = st.secrets.get("JOB_QUEUE_PATH", "jobs.db")
+# Optional port for the Prometheus /metrics endpoint; stage spans are logged as JSON either way
+METRICS_PORT = st.secrets.get("METRICS_PORT")
+SPAN_LOG_PATH = st.secrets.get("SPAN_LOG_PATH")
+ADMIN_USERS = st.secrets.get("ADMIN_USERS", [])
 
 # Email configuration
 EMAIL_ADDRESS = st.secrets["EMAIL_ADDRESS"]
 EMAIL_PASSWORD = st.secrets["EMAIL_PASSWORD"]
 RECIPIENT_EMAIL = st.secrets["RECIPIENT_EMAIL"]
+SMTP_HOST = st.secrets.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = st.secrets.get("SMTP_PORT", 587)
+SMTP_USE_TLS = st.secrets.get("SMTP_USE_TLS", True)
+# Attachment encoding: format (JPEG/WEBP/PNG), quality target and size budget
+EMAIL_IMAGE_FORMAT = st.secrets.get("EMAIL_IMAGE_FORMAT", "JPEG")
+EMAIL_IMAGE_QUALITY = st.secrets.get("EMAIL_IMAGE_QUALITY", 85)
+EMAIL_IMAGE_MAX_PIXELS = st.secrets.get("EMAIL_IMAGE_MAX_PIXELS", 1600 * 1600)
+EMAIL_IMAGE_MAX_BYTES = st.secrets.get("EMAIL_IMAGE_MAX_BYTES", 1_500_000)
+EMAIL_IMAGE_PROGRESSIVE = st.secrets.get("EMAIL_IMAGE_PROGRESSIVE", True)
+
+
+@st.cache_resource
+def get_mail_queue():
+    from mail_queue import MailQueue
+    return MailQueue(SMTP_HOST, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD, use_tls=SMTP_USE_TLS)
+
+
+@st.cache_resource
+def get_attachment_encoder():
+    from email_encoding import AttachmentEncoder
+    return AttachmentEncoder(EMAIL_IMAGE_FORMAT, quality=EMAIL_IMAGE_QUALITY, max_pixels=EMAIL_IMAGE_MAX_PIXELS,
+                             max_bytes=EMAIL_IMAGE_MAX_BYTES, progressive=EMAIL_IMAGE_PROGRESSIVE)
+
+
+# Jobs live in the SQLite queue whichever way they run, so they survive a
+# refresh or a server restart; the pages only poll them by id
+@st.cache_resource
+def get_job_manager():
+    from artifact_store import ImageHandle
+    queue = SQLiteJobQueue(JOB_QUEUE_PATH, max_concurrent=GENERATION_MAX_CONCURRENT, result_type=ImageHandle)
+    if GENERATION_WORKER != "external":
+        # Inline workers run the pipeline in this process, so it has to be configured first
+        get_pipeline()
+        from worker import start_workers
+        start_workers(queue, GENERATION_MAX_CONCURRENT)
+    return queue
+
+
+def submit_generation(username, complete_text, priority=0):
+    return get_job_manager().submit(username, {"complete_text": complete_text}, priority=priority)
+
+
+def reattach_job(username):
+    # A returning user (refresh, new tab, restarted server) continues with their last job
+    job = get_job_manager().latest_job(username)
+    if job is not None:
+        st.session_state.job_id = job.id
+        st.session_state.complete_text = job.payload["complete_text"]
+        st.session_state.page = "loading"
+
+
+def finish_job():
+    # Returns whether this call removed the job from the queue
+    job_id = st.session_state.get("job_id")
+    st.session_state.job_id = None
+    return bool(job_id) and get_job_manager().discard(job_id)
+
+
+# JSON span log, job gauges and the metrics endpoint, set up once per server process
+@st.cache_resource
+def get_metrics_server():
+    span_logger = logging.getLogger("dream.spans")
+    handler = logging.FileHandler(SPAN_LOG_PATH, encoding="utf-8") if SPAN_LOG_PATH else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    span_logger.addHandler(handler)
+    span_logger.setLevel(logging.INFO)
+    span_logger.propagate = False
+
+    stage_metrics.set_gauge("dream_jobs_in_flight", lambda: get_job_manager().in_flight())
+    stage_metrics.set_gauge("dream_jobs_queued", lambda: get_job_manager().queued())
+    if not METRICS_PORT:
+        return None
+    from metrics import MetricsServer
+    try:
+        return MetricsServer(port=int(METRICS_PORT)).start()
+    except OSError as e:
+        # E.g. another replica on this host already serves the port; the span log still works
+        logging.getLogger(__name__).warning("Not serving /metrics on port %s: %s", METRICS_PORT, e)
+        return None
 
 
 # Function to authenticate users
 def authenticate(username, password):
-    usernames = st.secrets["credentials"]["usernames"]
-    passwords = st.secrets["credentials"]["passwords"]
-
-    if username in usernames:
-        index = usernames.index(username)
-        if passwords[index] == password:
-            st.session_state.username = username  # Store the username in session state
-            return True
-    return False
+    profile = user_directory.authenticate(username, password)
+    if profile is None:
+        return False
+    # Store the canonical spelling, so storage and jobs see one name however it was typed
+    st.session_state.username = profile.username
+    return True
 
 
 # Custom CSS to enable RTL for the entire app, except for the fun fact section
@@ -89,167 +193,107 @@ fun_facts = [
 ]
 
 
-def translate_text(text):
-    translator = GoogleTranslator(source="iw", target="en")
-    return translator.translate(text)
+def send_email(subject, body, image_data, username, additional_recipient=None, image_name="dream_image.jpg",
+               image_subtype="jpeg"):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.image import MIMEImage
+    from email.header import Header
 
-
-def send_email(subject, body, image_data, username, additional_recipient=None):
     msg = MIMEMultipart()
     msg["From"] = EMAIL_ADDRESS
     msg["To"] = RECIPIENT_EMAIL
     if additional_recipient:
         msg["Cc"] = additional_recipient
     
-    # Get the user's image filename without extension
-    user_to_file = st.secrets["user_to_file"]
-    user_image_filename = os.path.splitext(user_to_file.get(username, ""))[0]
-    
-    # Add the user's image filename to the subject
-    full_subject = f"{subject} - {user_image_filename}"
+    # Tag the subject with the user's email tag (their photo's filename by default)
+    full_subject = f"{subject} - {user_directory.email_tag(username)}"
     msg["Subject"] = Header(full_subject, "utf-8")
 
     # Encode the body as UTF-8
     body_utf8 = body.encode("utf-8")
     msg.attach(MIMEText(body_utf8.decode("utf-8"), "plain", "utf-8"))
 
-    image = MIMEImage(image_data, name="dream_image.png")
+    image = MIMEImage(image_data, _subtype=image_subtype, name=image_name)
     msg.attach(image)
 
+    recipients = [RECIPIENT_EMAIL]
+    if additional_recipient:
+        recipients.append(additional_recipient)
+
+    # Hand the message to the background sender; delivery status is tracked by id
     try:
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            recipients = [RECIPIENT_EMAIL]
-            if additional_recipient:
-                recipients.append(additional_recipient)
-            server.sendmail(EMAIL_ADDRESS, recipients, msg.as_string())
-        return True
+        with span("email_enqueue", username=username):
+            return get_mail_queue().enqueue(EMAIL_ADDRESS, recipients, msg.as_string())
     except Exception as e:
         st.error(f"An error occurred while sending the email: {str(e)}")
-        return False
+        return None
 
 
-def upload_image_to_leonardo(image_file):
-    url = "https://cloud.leonardo.ai/api/rest/v1/init-image"
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {LEONARDO_API_KEY}"
-    }
-    
-    # Assume all images are JPEGs
-    payload = {"extension": "jpg"}
-    
-    response = requests.post(url, json=payload, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Failed to get presigned URL: {response.text}")
-    
-    upload_data = response.json()['uploadInitImage']
-    fields = json.loads(upload_data['fields'])
-    upload_url = upload_data['url']
-    image_id = upload_data['id']
-    
-    files = {'file': ('image.jpg', image_file, 'image/jpeg')}
-    response = requests.post(upload_url, data=fields, files=files)
-    if response.status_code != 204:
-        raise Exception(f"Failed to upload image: {response.status_code}")
-    
-    return image_id
+# Initialize session state
+if "authenticated" not in st.session_state:
+    st.session_state.authenticated = False
 
 
-def generate_image_leonardo(prompt, init_image_id, preset_style):
-    headers = {
-        "Authorization": f"Bearer {LEONARDO_API_KEY}",
-        "Content-Type": "application/json",
-    }
+def success_page():
+    st.title("Success!")
+    st.success("התמונה והפרומפט נשלחו בהצלחה")
+    st.write("ניתן לסגור חלון זה עכשיו או להמשיך לאפליקציה הראשית.")
 
-    escaped_prompt = prompt.replace("'", "\\'")
-
-    # First, generate an image based on the prompt alone
-    initial_payload = {
-        "prompt": escaped_prompt,
-        "modelId": "1e60896f-3c26-4296-8ecc-53e2afecc132",  # Leonardo Diffusion XL
-        "presetStyle": preset_style,
-        "photoReal": True,
-        "photoRealVersion": "v2",
-        "alchemy": True,
-        "num_images": 1,
-        "enhancePrompt": True,
-    }
 
-    initial_response = requests.post(LEONARDO_API_URL, json=initial_payload, headers=headers)
-
-    if initial_response.status_code != 200:
-        raise Exception(f"Failed to generate initial image: {initial_response.text}")
-
-    initial_generation_id = initial_response.json()["sdGenerationJob"]["generationId"]
-
-    # Poll for the generated initial image
-    while True:
-        status_response = requests.get(f"{LEONARDO_API_URL}/{initial_generation_id}", headers=headers)
-        if status_response.status_code == 200:
-            generation_data = status_response.json()["generations_by_pk"]
-            if generation_data["status"] == "COMPLETE":
-                generated_image_id = generation_data["generated_images"][0]["id"]
-                break
-        time.sleep(5)  # Wait for 5 seconds before polling again
-
-    # Now, generate the final images using both the uploaded and generated images as references
-    final_payload = {
-        "prompt": escaped_prompt,
-        "modelId": "1e60896f-3c26-4296-8ecc-53e2afecc132",  # Leonardo Diffusion XL
-        "presetStyle": preset_style,
-        "photoReal": True,
-        "photoRealVersion": "v2",
-        "alchemy": True,
-        "num_images": 4,
-        "enhancePrompt": True,
-        "controlnets": [
-            {
-                "initImageId": init_image_id,
-                "initImageType": "UPLOADED",
-                "preprocessorId": 133,  # Character Reference Id
-                "strengthType": "High",
-            },
-            {
-                "initImageId": generated_image_id,
-                "initImageType": "GENERATED",
-                "preprocessorId": 67,  # Character Reference Id
-                "strengthType": "Mid",
-            }
-        ] if init_image_id else [],
-    }
+def sending_page():
+    st.title("שולח את התמונה...")
+    email_status()
 
-    final_response = requests.post(LEONARDO_API_URL, json=final_payload, headers=headers)
 
-    if final_response.status_code == 200:
-        generation_id = final_response.json()["sdGenerationJob"]["generationId"]
+# The email is only queued when the user lands here, so follow the background sender.
+# The job and the selected image are kept until it is actually sent, so a failed
+# send can be retried; an unknown id (e.g. the server restarted) counts as not sent.
+@st.fragment(run_every=2)
+def email_status():
+    from mail_queue import QUEUED as EMAIL_QUEUED, SENT
 
-        # Poll for the generated images
-        while True:
-            status_response = requests.get(f"{LEONARDO_API_URL}/{generation_id}", headers=headers)
-            if status_response.status_code == 200:
-                generation_data = status_response.json()["generations_by_pk"]
-                if generation_data["status"] == "COMPLETE":
-                    return [image["url"] for image in generation_data["generated_images"]]
-            time.sleep(5)  # Wait for 5 seconds before polling again
+    status = get_mail_queue().status(st.session_state.get("email_message_id"))
+    if status is not None and status["status"] == SENT:
+        user_storage.set_last_email_sent(st.session_state.username)
+        finish_job()
+        st.session_state.page = "success"
+        st.rerun()
+    elif status is not None and status["status"] == EMAIL_QUEUED:
+        st.info("התמונה והפרומפט ממתינים לשליחה...")
     else:
-        raise Exception(f"Failed to generate final images: {final_response.text}")
+        st.error("לא הצלחנו לשלוח את התמונה והפרומפט")
+        if st.button("נסו לשלוח שוב", type="primary"):
+            send_selected_image(st.session_state.selected_image)
+            st.rerun()
+        if st.button("חזרה לתמונות"):
+            st.session_state.page = "show_images"
+            st.rerun()
 
 
-# Initialize session state
-if "authenticated" not in st.session_state:
-    st.session_state.authenticated = False
+def send_selected_image(handle):
+    # Encodes the chosen result and queues the email; returns the queued message id or None
+    encoder = get_attachment_encoder()
+    with span("encode_attachment", username=st.session_state.username):
+        img_byte_arr = encoder.encode(lambda: get_artifact_store().full_image(handle), cache_key=handle)
 
+    email_subject = "New Dream Image Generated"
+    email_body = f"A new dream image has been generated with the following prompt:\n\n{st.session_state.complete_text}"
+    additional_recipient = st.secrets["ADDITIONAL_RECIPIENT"]
+
+    message_id = send_email(email_subject, email_body, img_byte_arr, st.session_state.username, additional_recipient=additional_recipient,
+                            image_name=f"dream_image.{encoder.extension}", image_subtype=encoder.mime_subtype)
+    if message_id:
+        st.session_state.email_message_id = message_id
+        st.session_state.page = "sending"
+    return message_id
 
-def success_page():
-    st.title("Success!")
-    st.success("התמונה והפרומפט נשלחו בהצלחה")
-    st.write("ניתן לסגור חלון זה עכשיו או להמשיך לאפליקציה הראשית.")
 
 # Streamlit app
 def main():
+    get_metrics_server()
+    # Starts the inline workers on the first request, not on the first submitted dream
+    get_job_manager()
     if "page" not in st.session_state:
         st.session_state.page = "main"
 
@@ -257,6 +301,10 @@ def main():
         login_page()
         return
 
+    if "job_checked" not in st.session_state:
+        st.session_state.job_checked = True
+        reattach_job(st.session_state.username)
+
     # Create a container for the main content
     main_container = st.empty()
 
@@ -270,16 +318,32 @@ def main():
             st.write("אנא תארו חלום או דמיון שלכם. למשל, 'אני חולם לשחות עם להקת כרישים מסוכנים באוקיינוס' (עד 200 תוים).")
             st.write("מדובר בערב חברתי. נשמח לחלומות ודמיונות קלילים ומשעשעים.")
 
-            dream_description = st.text_area("בחלומי אני...", max_chars=200, height=100, placeholder="לדוגמה: במקום מסוים, עם אדם או חיה וכו'...")
+            # Start the reference upload as soon as the page shows, and the translation
+            # as soon as the text is committed, so both are ready when the job starts.
+            # Prefetched results stay in this process, so external workers couldn't use them.
+            prefetch = GENERATION_WORKER != "external"
+            if prefetch:
+                get_pipeline().prefetch_reference(st.session_state.username)
+            dream_description = st.text_area(
+                "בחלומי אני...", max_chars=200, height=100, placeholder="לדוגמה: במקום מסוים, עם אדם או חיה וכו'...",
+                key="dream_description",
+                on_change=(lambda: get_pipeline().prefetch_prompt(st.session_state.dream_description)) if prefetch else None,
+            )
 
             if st.button("צור תמונה", type="primary"):
-                if user_storage.can_generate_image(st.session_state.username):
-                    if dream_description:
-                        st.session_state.complete_text = dream_description
-                        st.session_state.page = "loading"
-                        st.rerun()
-                    else:
-                        st.warning("אנא תארו את החלום שלכם לפני יצירת התמונה.")
+                if not dream_description:
+                    st.warning("אנא תארו את החלום שלכם לפני יצירת התמונה.")
+                elif user_storage.try_consume_image(st.session_state.username):
+                    st.session_state.complete_text = dream_description
+                    # Submit the pipeline once; the loading page only polls the job
+                    # First-time requesters are served before users on a later attempt
+                    attempt = user_storage.get_user_data(st.session_state.username)["image_count"]
+                    st.session_state.job_id = submit_generation(
+                        st.session_state.username, dream_description, priority=attempt,
+                    )
+                    st.session_state.progress_value = 0.0
+                    st.session_state.page = "loading"
+                    st.rerun()
                 else:
                     st.error("הגעת למספר המקסימלי של תמונות שאתה יכול ליצור. אנא נסה שוב מאוחר יותר.")
 
@@ -287,70 +351,152 @@ def main():
                 st.session_state.authenticated = False
                 st.rerun()
 
+            if st.session_state.username in ADMIN_USERS and st.button("Metrics"):
+                st.session_state.page = "admin"
+                st.rerun()
+
     elif st.session_state.page == "loading":
+        job_manager = get_job_manager()
+        job = job_manager.get(st.session_state.get("job_id"))
+
+        if job is None:
+            st.session_state.error_message = "העבודה על התמונה אבדה, אנא נסו שוב."
+            st.session_state.page = "main"
+            st.rerun()
+        elif job.status == DONE:
+            # Kept until the user sends an image or starts over, so a refresh brings the results back
+            st.session_state.processed_images = job.result
+            st.session_state.page = "show_images"
+            st.rerun()
+        elif job.status == FAILED:
+            # A failed generation doesn't count against the user's quota; refunded
+            # only by the rerun that discarded the job, so a second tab can't refund it again
+            if finish_job():
+                user_storage.refund_image(st.session_state.username)
+            st.session_state.error_message = job.error
+            st.session_state.page = "main"
+            st.rerun()
+
         with main_container.container():
             st.title("יוצר את התמונה שלך...")
-            st.warning("אנא אל תסגור את הדף או תרענן אותו בזמן שאנחנו יוצרים את התמונה שלך.")
-            
-            with st.spinner("מעבד את החלום, זה יקח לי כמה דקות - אל תרדמו עדיין"):
-                status_text = st.empty()
-                
-                # Display random fun facts while processing
-                while True:
-                    status_text.text(random.choice(fun_facts))
-                    time.sleep(5)  # Update fun fact every 5 seconds
-                    
-                    # Check if images are ready
-                    processed_images = asyncio.run(generate_images_async())
-                    if processed_images:
-                        break
-
-            if processed_images:
-                st.session_state.processed_images = processed_images
-                st.session_state.page = "show_images"
-                st.rerun()
-            else:
-                st.session_state.page = "main"
-                st.rerun()
+            st.info("אפשר לרענן את הדף או לחזור מאוחר יותר - התמונה תמשיך להיווצר.")
+            st.write("מעבד את החלום, זה יקח לי כמה דקות - אל תרדמו עדיין")
+            loading_progress()
 
     elif st.session_state.page == "show_images":
         show_generated_images_page()
     
+    elif st.session_state.page == "sending":
+        sending_page()
+
     elif st.session_state.page == "success":
         success_page()
 
-async def generate_images_async():
-    try:
-        user_image = load_user_image(st.session_state.username)
-        init_image_id = None
-        thumbnail_image = None
-        if user_image:
-            img_byte_arr = BytesIO()
-            user_image.save(img_byte_arr, format='JPEG')
-            img_byte_arr.seek(0)
-            
-            init_image_id = upload_image_to_leonardo(img_byte_arr)
-            thumbnail_image = user_image
-
-        complete_text_english = translate_text(st.session_state.complete_text)
-        complete_text_english = "This is a picture of me. Place me according to the description: I am" + complete_text_english
-
-        image_urls = generate_image_leonardo(complete_text_english, init_image_id, "UNPROCESSED")
-
-        processed_images = []
-        for url in image_urls:
-            response = requests.get(url)
-            img = Image.open(BytesIO(response.content))
-
-            if thumbnail_image:
-                img = overlay_thumbnail(img, thumbnail_image)
-
-            processed_images.append(img)
+    elif st.session_state.page == "admin" and st.session_state.username in ADMIN_USERS:
+        admin_page()
+
+
+# Hebrew label per progress stage, and where that stage starts on the progress bar and how much of it it fills
+PROGRESS_DISPLAY = {
+    "queued": ("ממתין בתור", 0.0, 0.02),
+    "uploading": ("מכין את התמונה שלך", 0.02, 0.03),
+    "translating": ("מתרגם את החלום", 0.05, 0.05),
+    "initial_generation": ("יוצר טיוטה ראשונה", 0.1, 0.3),
+    "final_generation": ("יוצר את התמונות הסופיות", 0.4, 0.45),
+    "downloading": ("מוריד את התמונות", 0.85, 0.05),
+    "compositing": ("משלב אותך בתמונות", 0.9, 0.1),
+}
+
+
+def progress_fraction(progress):
+    label, start, share = PROGRESS_DISPLAY[progress.stage]
+    if progress.total:
+        return start + share * progress.done / progress.total
+    if progress.expected:
+        # Never show a generation phase as finished before Leonardo says so
+        return start + share * min((time.time() - progress.started) / progress.expected, 0.95)
+    return start
+
+
+# Re-runs on its own every second, so the page updates without sleeping in the script
+@st.fragment(run_every=1)
+def loading_progress():
+    job_manager = get_job_manager()
+    job = job_manager.get(st.session_state.get("job_id"))
+    if job is None or not job.is_active:
+        # Finished, failed or lost: the full page run moves on from here
+        st.rerun()
 
-        return processed_images
-    except Exception as e:
-        st.session_state.error_message = f"An error occurred: {str(e)}\n\n{traceback.format_exc()}"
-        return None
+    progress = job.progress
+    label = PROGRESS_DISPLAY[progress.stage][0]
+    if job.status == QUEUED:
+        estimated_minutes = max(round(job_manager.estimated_wait(job.id) / 60), 1)
+        text = f"את/ה במקום {job_manager.queue_position(job.id)} בתור. זמן המתנה משוער: כ-{estimated_minutes} דקות."
+    elif progress.total:
+        text = f"{label} ({progress.done}/{progress.total})"
+    elif progress.expected:
+        text = f"{label} ({round(time.time() - progress.started)} מתוך כ-{round(progress.expected)} שניות)"
+    else:
+        text = label
+    # The bar only moves forward, even when image stages report out of order
+    value = max(progress_fraction(progress), st.session_state.get("progress_value", 0.0))
+    st.session_state.progress_value = value
+    st.progress(min(value, 1.0), text=text)
+
+    # Rotate fun facts every 5 seconds, independent of how often we poll the job
+    st.text(fun_facts[int(time.time() // 5) % len(fun_facts)])
+
+    # Show results that have already arrived while the rest are downloading
+    if job.partial_results:
+        cols = st.columns(2)
+        for i, handle in sorted(job.partial_results.items()):
+            with cols[i % 2]:
+                st.image(get_artifact_store().preview(handle), caption=f"תמונה {i+1}", use_column_width=True)
+
+
+def admin_page():
+    st.title("Pipeline metrics")
+    job_manager = get_job_manager()
+    col1, col2 = st.columns(2)
+    col1.metric("Jobs in flight", job_manager.in_flight())
+    col2.metric("Jobs queued", job_manager.queued())
+
+    if GENERATION_WORKER == "external":
+        # Stage spans are recorded in the process that runs the pipeline
+        st.info("Generations run in worker.py, so the stages below only cover this app process. "
+                "See the workers' /metrics endpoint (worker.py --metrics-port) for the pipeline stages.")
+
+    summary = stage_metrics.summary()
+    if not summary:
+        st.info("No stages have run yet.")
+    else:
+        st.dataframe(
+            [
+                {
+                    "stage": stage,
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "p50 (s)": entry["p50_seconds"],
+                    "p95 (s)": entry["p95_seconds"],
+                    "mean (s)": entry["mean_seconds"],
+                }
+                for stage, entry in sorted(summary.items())
+            ],
+            use_container_width=True,
+        )
+        for stage, entry in sorted(summary.items()):
+            st.subheader(stage)
+            # Runs per latency bucket, labelled by the bucket's upper bound in seconds
+            st.bar_chart({"runs": entry["buckets"]}, x_label="seconds", sort=False)
+
+    st.subheader("Generation strategies")
+    st.json(strategy_stats.summary())
+
+    if st.button("Refresh"):
+        st.rerun()
+    if st.button("Back"):
+        st.session_state.page = "main"
+        st.rerun()
 
 def login_page():
     st.title("Login")
@@ -360,81 +506,50 @@ def login_page():
     if st.button("Login"):
         if authenticate(username, password):
             st.session_state.authenticated = True
-            st.session_state.username = username
             st.success(f"Welcome {username}!")
             st.rerun()
         else:
             st.error("Invalid username or password")
 
 
-def overlay_thumbnail(main_image, thumbnail, max_size=(300, 300), position=(10, 10)):
-    # Calculate the thumbnail size while maintaining aspect ratio
-    thumbnail.thumbnail(max_size, Image.LANCZOS)
-    
-    # Create a new image with an alpha channel for the border
-    thumb_w, thumb_h = thumbnail.size
-    thumbnail_with_border = Image.new('RGBA', (thumb_w+4, thumb_h+4), (255, 255, 255, 0))
-    
-    # Draw a white border
-    draw = ImageDraw.Draw(thumbnail_with_border)
-    draw.rectangle([0, 0, thumb_w+3, thumb_h+3], outline=(255, 255, 255, 255), width=2)
-    
-    # Paste the resized thumbnail onto the new image
-    thumbnail_with_border.paste(thumbnail, (2, 2))
-    
-    # Paste the thumbnail with border onto the main image
-    main_image.paste(thumbnail_with_border, position, thumbnail_with_border)
-    return main_image
-
-
-def load_user_image(username):
-    user_to_file = st.secrets["user_to_file"]
-    if username in user_to_file:
-        image_path = os.path.join("images", user_to_file[username])
-        if os.path.exists(image_path):
-            return Image.open(image_path)
-    return None
-
 def show_generated_images_page():
     st.title("התמונות שנוצרו")
     st.write("בחר את התמונה שברצונך לשלוח:")
 
     cols = st.columns(2)
-    for i, img in enumerate(st.session_state.processed_images):
+    artifact_store = get_artifact_store()
+    if not all(artifact_store.exists(handle) for handle in st.session_state.processed_images):
+        st.session_state.error_message = "התמונות כבר אינן זמינות, אנא צרו תמונה חדשה."
+        finish_job()
+        st.session_state.processed_images = None
+        st.session_state.page = "main"
+        st.rerun()
+
+    for i, handle in enumerate(st.session_state.processed_images):
         with cols[i % 2]:
-            st.image(img, caption=f"תמונה {i+1}", use_column_width=True)
+            st.image(artifact_store.preview(handle), caption=f"תמונה {i+1}", use_column_width=True)
             if st.button(f"בחר תמונה {i+1}", key=f"select_image_{i}"):
-                st.session_state.selected_image = img
+                st.session_state.selected_image = handle
 
                 st.write("התמונה הנבחרת:")
-                st.image(st.session_state.selected_image, caption="התמונה שנבחרה מהחלום שלך")
-
-                img_byte_arr = BytesIO()
-                st.session_state.selected_image.save(img_byte_arr, format="PNG")
-                img_byte_arr = img_byte_arr.getvalue()
-
-                email_subject = "New Dream Image Generated"
-                email_body = f"A new dream image has been generated with the following prompt:\n\n{st.session_state.complete_text}"
-                additional_recipient = st.secrets["ADDITIONAL_RECIPIENT"]
-                
-                with st.spinner("שולח את התמונה"):
-                    if send_email(email_subject, email_body, img_byte_arr, st.session_state.username, additional_recipient=additional_recipient):
-                        user_storage.set_last_email_sent(st.session_state.username)
-                        st.session_state.page = "success"
-                        st.rerun()
-                    else:
-                        st.error("לא הצלחנו לשלוח את התמונה והפרומפט")
+                st.image(artifact_store.preview(handle), caption="התמונה שנבחרה מהחלום שלך")
+
+                if send_selected_image(handle):
+                    st.rerun()
+                else:
+                    st.error("לא הצלחנו לשלוח את התמונה והפרומפט")
 
     # Calculate remaining attempts
     user_data = user_storage.get_user_data(st.session_state.username)
-    remaining_attempts = 3 - user_data["image_count"]
+    limit = user_storage.image_limit(st.session_state.username)
+    remaining_attempts = "∞" if limit is None else max(limit - user_data["image_count"], 0)
 
     if st.button(f"התחל מחדש (נותרו {remaining_attempts} ניסיונות)", key="regenerate", type="primary"):
+        finish_job()
         st.session_state.processed_images = None
         st.session_state.selected_image = None
         st.session_state.complete_text = None
         st.session_state.page = "main"
-        user_storage.increment_image_count(st.session_state.username)
         st.rerun()
 
 if __name__ == "__main__":
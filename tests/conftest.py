@@ -0,0 +1,32 @@
+import pytest
+
+from fake_leonardo import FakeLeonardoServer
+from fake_smtp import FakeSMTPServer
+
+
+@pytest.fixture
+def smtp():
+    # Starts a FakeSMTPServer with the given options; stopped after the test
+    def start(**kwargs):
+        server = FakeSMTPServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    servers = []
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def leonardo():
+    # Starts a FakeLeonardoServer with the given options; stopped after the test
+    def start(**kwargs):
+        server = FakeLeonardoServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    servers = []
+    yield start
+    for server in servers:
+        server.stop()
@@ -0,0 +1,24 @@
+import os
+import shutil
+
+from PIL import Image
+
+from artifact_store import ArtifactStore
+
+
+def test_evict_skips_jobs_another_evict_already_removed(tmp_path, monkeypatch):
+    store = ArtifactStore(str(tmp_path), max_disk_bytes=0)
+    store.put("old", 0, Image.new("RGB", (32, 32)))
+
+    # The "old" directory disappears between listing the root and sizing it
+    scandir = os.scandir
+
+    def racing_scandir(path):
+        if path == os.path.join(str(tmp_path), "old"):
+            shutil.rmtree(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", racing_scandir)
+    handle = store.put("new", 0, Image.new("RGB", (32, 32)))
+
+    assert store.exists(handle)
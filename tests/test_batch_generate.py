@@ -0,0 +1,9 @@
+from batch_generate import read_rows
+
+
+def test_rows_without_a_dream_are_skipped_with_their_line_number(tmp_path, capsys):
+    path = tmp_path / "dreams.csv"
+    path.write_text("\ufeffusername,dream\nguest,a dream\nlonely\n\nother,\"two\nlines\"\n", encoding="utf-8")
+
+    assert read_rows(str(path)) == [("guest", "a dream"), ("other", "two\nlines")]
+    assert "line 3" in capsys.readouterr().out
@@ -0,0 +1,17 @@
+from PIL import Image
+
+from email_encoding import AttachmentEncoder
+
+
+def test_cache_hit_does_not_load_the_image():
+    encoder = AttachmentEncoder("JPEG")
+    loads = []
+
+    def load():
+        loads.append(1)
+        return Image.new("RGB", (64, 64), (200, 30, 30))
+
+    first = encoder.encode(load, cache_key="job:0")
+    assert encoder.encode(load, cache_key="job:0") == first
+    assert len(loads) == 1
+    assert first[:2] == b"\xff\xd8"
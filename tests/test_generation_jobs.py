@@ -0,0 +1,54 @@
+import time
+
+from generation_jobs import DONE, RUNNING, SQLiteJobQueue
+
+
+def test_claim_enforces_max_concurrent_across_queue_instances(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    # Two handles on one file, like the app and a worker.py process
+    app, worker = SQLiteJobQueue(path, max_concurrent=2), SQLiteJobQueue(path, max_concurrent=2)
+    for i in range(3):
+        app.submit(f"guest {i}", {"complete_text": "dream"})
+
+    first, _ = worker.claim("worker-1")
+    second, _ = app.claim("inline-1")
+    assert worker.claim("worker-2") is None
+    assert app.in_flight() == 2
+
+    # A finished job frees its slot for the next one in line
+    worker.complete(first.id, [])
+    third, _ = app.claim("inline-2")
+    assert third.username == "guest 2"
+    assert app.get(second.id).status == RUNNING
+    assert app.get(first.id).status == DONE
+
+
+def test_job_of_a_dead_worker_is_requeued_with_its_checkpoint(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.db"), stale_after=0.2)
+    queue.submit("guest", {"complete_text": "dream"})
+    job, _ = queue.claim("worker-1")
+    job.save_checkpoint("final_generation_id", "generation-1")
+
+    # Still beating: nobody else gets it
+    time.sleep(0.1)
+    queue.heartbeat([job.id])
+    time.sleep(0.15)
+    assert queue.claim("worker-2") is None
+
+    # The worker stops beating, so the next claim takes the job over where it left off
+    time.sleep(0.25)
+    resumed, payload = queue.claim("worker-2")
+    assert resumed.id == job.id
+    assert resumed.checkpoint == {"final_generation_id": "generation-1"}
+    assert payload == {"complete_text": "dream"}
+
+
+def test_only_the_first_discard_removes_the_job(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    # Two tabs of the same user seeing the job fail at once
+    first_tab, second_tab = SQLiteJobQueue(path), SQLiteJobQueue(path)
+    job_id = first_tab.submit("guest", {"complete_text": "dream"})
+
+    assert first_tab.discard(job_id) is True
+    assert second_tab.discard(job_id) is False
+    assert first_tab.get(job_id) is None
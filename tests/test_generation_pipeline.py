@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+import generation_pipeline
+from generation_jobs import Job
+from generation_waiter import GenerationTimeout
+
+
+@pytest.fixture
+def pipeline(leonardo):
+    def configure(**kwargs):
+        server = leonardo(**kwargs)
+        generation_pipeline.configure({
+            "LEONARDO_API_KEY": "test",
+            "LEONARDO_API_URL": server.base_url,
+            "LEONARDO_RATE_LIMIT_PATH": "",
+            "GENERATION_EXPECTED_DURATIONS": {"initial": 0.2, "final": 0.2},
+            "GENERATION_DEADLINE": 2,
+        }, callbacks=False)
+        return server
+
+    def reset():
+        for getter in (generation_pipeline.get_rate_limiter, generation_pipeline.get_leonardo_client,
+                       generation_pipeline.get_generation_waiter):
+            getter.cache_clear()
+
+    reset()
+    yield configure
+    reset()
+
+
+def test_resumed_job_polls_its_checkpointed_generation(pipeline):
+    server = pipeline(durations={4: (0.2, 0.2)})
+    client = generation_pipeline.get_leonardo_client()
+    generation_id = asyncio.run(client.create_generation({"num_images": 4}))["generationId"]
+
+    job = Job("guest")
+    job.checkpoint = {"strategy": "prompt_only", "final_generation_id": generation_id}
+    urls = asyncio.run(generation_pipeline.generate_image_leonardo("a dream", None, "UNPROCESSED", job=job))
+
+    assert len(urls) == 4
+    assert server.calls["create_generation"] == 1
+
+
+def test_timed_out_generation_is_not_resumed(pipeline):
+    server = pipeline(durations={4: (30.0, 30.0)})
+    job = Job("guest")
+
+    with pytest.raises(GenerationTimeout):
+        asyncio.run(generation_pipeline.generate_image_leonardo("a dream", None, "UNPROCESSED", job=job))
+    assert job.checkpoint == {"strategy": "prompt_only"}
+    assert server.calls["create_generation"] == 1
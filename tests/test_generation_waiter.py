@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import pytest
+
+from generation_waiter import CallbackReceiver, DurationStats, GenerationTimeout, GenerationWaiter
+from leonardo_client import LeonardoClient
+
+
+def submit(client, num_images=1):
+    return asyncio.run(client.create_generation({"num_images": num_images}))["generationId"]
+
+
+def test_next_delay_is_capped_before_and_after_the_expected_finish():
+    waiter = GenerationWaiter(None, min_interval=1.0, max_interval=5.0, backoff=2.0)
+    # A pessimistic prior doesn't hold back the first poll
+    assert waiter.next_delay(0, 45.0, None) == 5.0
+    assert waiter.next_delay(0, 4.0, None) == 2.0
+    assert waiter.next_delay(3.5, 4.0, None) == 1.0
+    # Past the expected finish the delay backs off but never beyond max_interval
+    assert waiter.next_delay(10, 4.0, None) == 1.0
+    assert waiter.next_delay(10, 4.0, 1.0) == 2.0
+    assert waiter.next_delay(10, 4.0, 4.0) == 5.0
+
+
+def test_polling_detects_completion_close_to_the_expected_duration(leonardo):
+    server = leonardo(durations={1: (0.6, 0.6)})
+    client = LeonardoClient("test", base_url=server.base_url)
+    waiter = GenerationWaiter(client, stats=DurationStats(defaults={"initial": 0.6}),
+                              min_interval=0.1, max_interval=0.5)
+
+    generation_id = submit(client)
+    start = time.monotonic()
+    generation = asyncio.run(waiter.wait(generation_id, "initial"))
+
+    assert generation["status"] == "COMPLETE"
+    # Halving towards the expected finish: a handful of polls, seen within one min_interval
+    assert time.monotonic() - start < 0.6 + 0.1 + 0.2
+    assert server.calls["get_generation"] <= 5
+    assert 0.5 < waiter.stats.get("initial") < 1.0
+
+
+def test_slow_job_is_seen_within_max_interval(leonardo):
+    server = leonardo(durations={1: (0.3, 0.3)})
+    client = LeonardoClient("test", base_url=server.base_url)
+    # A prior far above the real duration, like the built-in defaults against the fake
+    waiter = GenerationWaiter(client, stats=DurationStats(defaults={"initial": 60.0}),
+                              min_interval=0.1, max_interval=0.5)
+
+    generation_id = submit(client)
+    start = time.monotonic()
+    asyncio.run(waiter.wait(generation_id, "initial"))
+
+    assert time.monotonic() - start < 0.5 + 0.2
+    assert server.calls["get_generation"] == 1
+
+
+def test_deadline_stops_polling_a_stuck_job(leonardo):
+    server = leonardo(durations={1: (30.0, 30.0)})
+    client = LeonardoClient("test", base_url=server.base_url)
+    waiter = GenerationWaiter(client, min_interval=0.1, max_interval=0.2, deadline=0.5)
+
+    generation_id = submit(client)
+    start = time.monotonic()
+    with pytest.raises(GenerationTimeout):
+        asyncio.run(waiter.wait(generation_id, "initial"))
+    assert time.monotonic() - start < 0.5 + 0.3
+
+
+def test_webhook_wakes_the_waiter_before_the_next_poll(leonardo):
+    receiver = CallbackReceiver(host="127.0.0.1", port=0, token="secret").start()
+    host, port = receiver.server.server_address[:2]
+    try:
+        server = leonardo(durations={1: (0.3, 0.3)}, callback_url=f"http://{host}:{port}/leonardo-callback",
+                      callback_token="secret")
+        client = LeonardoClient("test", base_url=server.base_url)
+        # Polling alone would not look again for 5 seconds
+        waiter = GenerationWaiter(client, stats=DurationStats(defaults={"initial": 60.0}), receiver=receiver,
+                                  min_interval=5.0, max_interval=5.0)
+
+        generation_id = submit(client)
+        start = time.monotonic()
+        generation = asyncio.run(waiter.wait(generation_id, "initial"))
+
+        assert generation["status"] == "COMPLETE"
+        assert time.monotonic() - start < 1.5
+        assert server.calls["get_generation"] == 1
+        assert generation_id not in receiver.events
+    finally:
+        receiver.stop()
+
+
+def test_pushes_for_generations_nobody_waits_on_are_dropped():
+    receiver = CallbackReceiver(host="127.0.0.1", port=0)
+    try:
+        receiver.notify("finished-long-ago")
+        assert receiver.events == {}
+
+        receiver.watch("pending")
+        receiver.notify("pending")
+        assert receiver.wait("pending", 0)
+        receiver.forget("pending")
+        receiver.notify("pending")
+        assert receiver.events == {}
+    finally:
+        receiver.server.server_close()
@@ -0,0 +1,23 @@
+from init_image_cache import InitImageCache
+
+
+def test_instances_sharing_a_file_see_each_others_entries(tmp_path):
+    path = str(tmp_path / "init_image_cache.json")
+    app = InitImageCache(path)
+    warmer = InitImageCache(path)
+
+    # Written after the app loaded the file, as warm_init_images.py would
+    warmer.set("guest", b"photo", "init-1")
+    assert app.get("guest", b"photo") == "init-1"
+
+    # A write from a stale instance keeps the other instance's entries
+    app.set("other", b"photo", "init-2")
+    reloaded = InitImageCache(path)
+    assert reloaded.get("guest", b"photo") == "init-1"
+    assert reloaded.get("other", b"photo") == "init-2"
+
+
+def test_expired_entries_are_missed(tmp_path):
+    cache = InitImageCache(str(tmp_path / "init_image_cache.json"), ttl=-1)
+    cache.set("guest", b"photo", "init-1")
+    assert cache.get("guest", b"photo") is None
@@ -0,0 +1,25 @@
+import time
+
+import pytest
+
+from leonardo_client import LeonardoAPIError, LeonardoClient
+
+
+def test_unknown_generation_fails_instead_of_polling_on(leonardo):
+    server = leonardo()
+    client = LeonardoClient("test", base_url=server.base_url)
+
+    with pytest.raises(LeonardoAPIError) as error:
+        client.get_generation_sync("no-such-generation")
+    assert error.value.status_code == 404
+
+
+def test_retry_after_past_the_deadline_is_not_waited_out(leonardo):
+    # Every call is answered 429 with Retry-After: 1
+    server = leonardo(rate_limit_rate=1.0)
+    client = LeonardoClient("test", base_url=server.base_url)
+
+    start = time.monotonic()
+    assert client.get_generation_sync("generation-1", deadline=start + 0.3) is None
+    assert time.monotonic() - start < 1
+    assert server.calls["rate_limited"] == 1
@@ -0,0 +1,88 @@
+import smtplib
+import time
+
+from mail_queue import FAILED, QUEUED, SENT, MailQueue, _is_transient
+
+
+def test_only_temporary_failures_are_retried():
+    assert _is_transient(smtplib.SMTPServerDisconnected("closed"))
+    assert _is_transient(ConnectionRefusedError())
+    assert _is_transient(TimeoutError())
+    assert _is_transient(smtplib.SMTPResponseException(451, b"try again later"))
+    assert _is_transient(smtplib.SMTPConnectError(421, b"too busy"))
+
+    assert not _is_transient(smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server"))
+    assert not _is_transient(smtplib.SMTPAuthenticationError(535, b"bad credentials"))
+    assert not _is_transient(smtplib.SMTPResponseException(550, b"mailbox unavailable"))
+
+
+def test_finished_statuses_are_pruned_after_keep_finished():
+    queue = MailQueue("127.0.0.1", 0, None, None, keep_finished=60)
+    old = time.time() - 120
+    queue.statuses = {
+        "sent": {"status": SENT, "attempts": 1, "error": None, "updated": old},
+        "failed": {"status": FAILED, "attempts": 6, "error": "550", "updated": old},
+        "retrying": {"status": QUEUED, "attempts": 2, "error": "421", "updated": old},
+        "recent": {"status": SENT, "attempts": 1, "error": None, "updated": time.time()},
+    }
+    with queue.condition:
+        queue._prune()
+
+    assert set(queue.statuses) == {"retrying", "recent"}
+
+
+def wait_for(queue, message_id, statuses=(SENT, FAILED), timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = queue.status(message_id)
+        if status["status"] in statuses:
+            return status
+        time.sleep(0.01)
+    raise AssertionError(f"message {message_id} still {queue.status(message_id)['status']}")
+
+
+def message(subject):
+    return f"Subject: {subject}\r\n\r\nA dream\r\n"
+
+
+def test_messages_are_delivered_over_one_connection(smtp):
+    server = smtp()
+    queue = MailQueue(*server.address, "dreams@example.com", "secret", use_tls=False)
+
+    message_ids = [queue.enqueue("dreams@example.com", ["inbox@example.com"], message(f"dream {i}")) for i in range(3)]
+    for message_id in message_ids:
+        assert wait_for(queue, message_id)["status"] == SENT
+
+    assert sorted(m["message"]["Subject"] for m in server.messages) == ["dream 0", "dream 1", "dream 2"]
+    assert server.messages[0]["recipients"] == ["<inbox@example.com>"]
+    assert server.connections == 1
+
+
+def test_temporary_rejection_is_retried_until_delivered(smtp):
+    server = smtp(failure_rate=1.0)
+    queue = MailQueue(*server.address, None, None, use_tls=False, retry_delay=0.05)
+
+    message_id = queue.enqueue("dreams@example.com", ["inbox@example.com"], message("dream"))
+    deadline = time.monotonic() + 5
+    while server.rejected == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    server.failure_rate = 0.0
+
+    status = wait_for(queue, message_id)
+    assert status["status"] == SENT
+    assert status["attempts"] >= 2
+    assert len(server.messages) == 1
+
+
+def test_message_fails_after_the_last_retry(smtp):
+    server = smtp(failure_rate=1.0)
+    queue = MailQueue(*server.address, None, None, use_tls=False, max_retries=2, retry_delay=0.01)
+
+    message_id = queue.enqueue("dreams@example.com", ["inbox@example.com"], message("dream"))
+    status = wait_for(queue, message_id)
+
+    assert status["status"] == FAILED
+    assert status["attempts"] == 3
+    assert "451" in status["error"]
+    assert server.rejected == 3
+    assert server.messages == []
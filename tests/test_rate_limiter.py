@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from rate_limiter import MemoryBucketStore, RateLimiter, SQLiteBucketStore, refill, take_token
+
+
+def test_bucket_refills_at_its_rate_up_to_capacity():
+    assert refill(0.0, 10.0, 12.0, 2.0, 5) == 4.0
+    assert refill(3.0, 10.0, 20.0, 2.0, 5) == 5
+    assert take_token(2.5, 0.0, 10.0, 1.0) == (1.5, 0.0)
+    # Half a token left at one per second: wait half a second
+    assert take_token(0.5, 0.0, 10.0, 1.0) == (0.5, 0.5)
+    # Paused until 12: wait out the pause whatever the tokens say
+    assert take_token(5.0, 12.0, 10.0, 1.0) == (5.0, 2.0)
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+def test_burst_is_free_and_then_calls_are_paced(tmp_path, store):
+    make_store = (lambda: SQLiteBucketStore(str(tmp_path / "rate_limits.db"))) if store == "sqlite" else MemoryBucketStore
+    limiter = RateLimiter({"poll": (20.0, 3)}, store=make_store())
+
+    assert sum(limiter.acquire("poll") for _ in range(3)) == 0
+    start = time.monotonic()
+    limiter.acquire("poll")
+    limiter.acquire("poll")
+    assert 0.08 < time.monotonic() - start < 0.3
+
+
+def test_processes_sharing_the_sqlite_store_share_one_bucket(tmp_path):
+    path = str(tmp_path / "rate_limits.db")
+    app = RateLimiter({"submit": (1.0, 2)}, store=SQLiteBucketStore(path))
+    worker = RateLimiter({"submit": (1.0, 2)}, store=SQLiteBucketStore(path))
+
+    app.acquire("submit")
+    worker.acquire("submit")
+    assert app.utilisation("submit") == pytest.approx(1.0, abs=0.01)
+
+
+def test_pause_holds_back_every_caller_on_the_bucket():
+    limiter = RateLimiter({"submit": (50.0, 5)})
+    limiter.pause("submit", 0.2)
+    assert limiter.utilisation("submit") == 1.0
+
+    start = time.monotonic()
+    limiter.acquire("submit")
+    assert time.monotonic() - start >= 0.19
@@ -0,0 +1,38 @@
+import json
+
+from translation import Translator
+
+
+class CountingBackend:
+    def __init__(self):
+        self.calls = 0
+
+    def translate(self, text):
+        self.calls += 1
+        return f"en:{text}"
+
+
+def test_translators_sharing_a_file_reuse_each_others_results(tmp_path):
+    path = str(tmp_path / "translation_cache.json")
+    app_backend, worker_backend = CountingBackend(), CountingBackend()
+    app = Translator(app_backend, cache_path=path)
+    worker = Translator(worker_backend, cache_path=path)
+
+    assert worker.translate("חלום  ראשון") == "en:חלום ראשון"
+    assert app.translate("חלום ראשון") == "en:חלום ראשון"
+    assert app_backend.calls == 0
+
+    # A write from the instance that loaded the file first keeps the other's entries
+    app.translate("חלום שני")
+    with open(path, encoding="utf-8") as f:
+        assert set(json.load(f)) == {"חלום ראשון", "חלום שני"}
+
+
+def test_disk_cache_keeps_the_most_recent_entries(tmp_path):
+    path = str(tmp_path / "translation_cache.json")
+    translator = Translator(CountingBackend(), cache_path=path, max_disk_entries=2)
+    for text in ("one", "two", "three"):
+        translator.translate(text)
+
+    with open(path, encoding="utf-8") as f:
+        assert list(json.load(f)) == ["two", "three"]
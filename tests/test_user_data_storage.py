@@ -0,0 +1,54 @@
+import importlib
+import threading
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def storage_module(tmp_path_factory):
+    # user_data_storage reads st.secrets at import time
+    from streamlit import config as st_config
+
+    workdir = tmp_path_factory.mktemp("user_data_storage")
+    secrets_path = workdir / "secrets.toml"
+    secrets_path.write_text(
+        f'USER_STORAGE_PATH = "{workdir / "user_data.db"}"\n'
+        '[credentials]\nusernames = ["guest"]\npasswords = ["password"]\n',
+        encoding="utf-8",
+    )
+    st_config.set_option("secrets.files", [str(secrets_path)])
+    return importlib.import_module("user_data_storage")
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "json"])
+def test_concurrent_attempts_never_exceed_the_quota(storage_module, tmp_path, kind):
+    path = str(tmp_path / f"user_data.{'db' if kind == 'sqlite' else 'json'}")
+    # One storage per thread, like separate tabs served by separate processes
+    storages = [storage_module.UserStorage(storage_module.create_backend(kind, path)) for _ in range(12)]
+    barrier = threading.Barrier(len(storages))
+    granted = []
+
+    def attempt(storage):
+        barrier.wait()
+        if storage.try_consume_image("guest"):
+            granted.append(True)
+
+    threads = [threading.Thread(target=attempt, args=(storage,)) for storage in storages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(granted) == storage_module.IMAGE_LIMIT
+    assert storages[0].get_user_data("guest")["image_count"] == storage_module.IMAGE_LIMIT
+
+
+def test_refund_gives_an_attempt_back(storage_module, tmp_path):
+    storage = storage_module.UserStorage(storage_module.create_backend("sqlite", str(tmp_path / "user_data.db")))
+    for _ in range(storage_module.IMAGE_LIMIT):
+        assert storage.try_consume_image("guest")
+    assert not storage.try_consume_image("guest")
+
+    storage.refund_image("guest")
+    assert storage.try_consume_image("guest")
+    assert not storage.try_consume_image("guest")
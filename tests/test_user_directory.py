@@ -0,0 +1,33 @@
+from user_directory import UserDirectory, hash_password, verify_password
+
+
+def directory(passwords):
+    return UserDirectory.from_settings({
+        "credentials": {"usernames": list(passwords), "passwords": list(passwords.values())},
+        "user_to_file": {"דוד זלצר": "דוד זלצר.jpg"},
+    })
+
+
+def test_plaintext_and_hashed_passwords_authenticate():
+    users = directory({"דוד זלצר": "plain", "guest": hash_password("secret", iterations=1000)})
+
+    # Names match however the spaces were typed, and come back in the canonical spelling
+    assert users.authenticate("דודזלצר", "plain").username == "דוד זלצר"
+    assert users.authenticate("guest", "secret").username == "guest"
+    assert users.authenticate("guest", "plain") is None
+    assert users.authenticate("דוד זלצר", "Plain") is None
+
+
+def test_malformed_hash_is_a_failed_login():
+    assert not verify_password("secret", "pbkdf2_sha256$not-a-number$zz$00")
+    assert not verify_password("secret", "pbkdf2_sha256$1000")
+    assert directory({"guest": "pbkdf2_sha256$oops"}).authenticate("guest", "pbkdf2_sha256$oops") is None
+
+
+def test_only_guests_listed_in_unlimited_users_are_unlimited():
+    users = directory({"דוד זלצר": "plain", "guest": "plain"})
+    assert users.quota("דוד זלצר") == users.quota("guest") == 3
+
+    users = UserDirectory.from_settings({"credentials": {"usernames": ["guest"], "passwords": ["plain"]},
+                                         "UNLIMITED_USERS": ["guest"]})
+    assert users.quota("guest") is None
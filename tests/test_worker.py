@@ -0,0 +1,26 @@
+import threading
+
+from worker import work
+
+
+class FlakyQueue:
+    # Claiming fails twice, like a queue database that is briefly locked
+    def __init__(self):
+        self.claims = 0
+        self.recovered = threading.Event()
+
+    def claim(self, name):
+        self.claims += 1
+        if self.claims <= 2:
+            raise RuntimeError("database is locked")
+        self.recovered.set()
+        return None
+
+
+def test_worker_thread_survives_queue_errors():
+    queue = FlakyQueue()
+    thread = threading.Thread(target=work, args=(queue, "worker-1", 0.01, set(), threading.Lock()), daemon=True)
+    thread.start()
+
+    assert queue.recovered.wait(timeout=5)
+    assert thread.is_alive()
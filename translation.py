@@ -0,0 +1,129 @@
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from locked_json import locked_json, load_json
+
+DEFAULT_CACHE_PATH = "translation_cache.json"
+
+
+def normalize_text(text):
+    # Same dream typed twice should hit the same cache entry
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class GoogleBackend:
+    def __init__(self, source="iw", target="en"):
+        self.source = source
+        self.target = target
+        # GoogleTranslator keeps per-request state on the instance, so reuse one per thread
+        self.local = threading.local()
+
+    def translate(self, text):
+        translator = getattr(self.local, "translator", None)
+        if translator is None:
+            from deep_translator import GoogleTranslator
+
+            translator = GoogleTranslator(source=self.source, target=self.target)
+            self.local.translator = translator
+        return translator.translate(text)
+
+
+class OfflineBackend:
+    # No-network backend for tests and degraded mode: applies an optional
+    # glossary and otherwise passes the text through (the model copes with Hebrew
+    # far better than with a failed generation).
+    def __init__(self, glossary=None):
+        self.glossary = glossary or {}
+
+    def translate(self, text):
+        for source, target in self.glossary.items():
+            text = text.replace(source, target)
+        return text
+
+
+BACKENDS = {"google": GoogleBackend, "offline": OfflineBackend}
+
+
+class Translator:
+    # Translations are kept in an in-memory LRU and a JSON file shared by every
+    # process (the app and worker.py). Writes merge into what is on disk under
+    # an flock, and a miss re-reads the file before calling the backend. The
+    # file keeps the max_disk_entries most recently stored translations.
+    def __init__(self, backend, fallback=None, cache_path=DEFAULT_CACHE_PATH, max_entries=1024,
+                 max_disk_entries=10000, timeout=5.0):
+        self.backend = backend
+        self.fallback = fallback or OfflineBackend()
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.timeout = timeout
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="translate")
+        self.disk = load_json(cache_path) if cache_path else {}
+
+    def cached(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            value = self.disk.get(key)
+        if value is None and self.cache_path:
+            # Another process may have translated it since we last read the file
+            with locked_json(self.cache_path, self.file_lock) as disk:
+                value = disk.get(key)
+            with self.lock:
+                self.disk = disk
+        if value is not None:
+            with self.lock:
+                self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def store(self, key, value):
+        with self.lock:
+            self._remember(key, value)
+        if not self.cache_path:
+            return
+        with locked_json(self.cache_path, self.file_lock) as disk:
+            # Newest last, so trimming drops the translations stored longest ago
+            disk.pop(key, None)
+            disk[key] = value
+            for old_key in list(disk)[:max(len(disk) - self.max_disk_entries, 0)]:
+                del disk[old_key]
+        with self.lock:
+            self.disk = disk
+
+    def translate(self, text):
+        key = normalize_text(text)
+        if not key:
+            return ""
+        result = self.cached(key)
+        if result is not None:
+            return result
+
+        # Bounded latency: if the backend is slow or down, use the fallback and don't cache it
+        future = self.executor.submit(self.backend.translate, key)
+        try:
+            result = future.result(timeout=self.timeout)
+        except Exception:
+            return self.fallback.translate(key)
+        if not result:
+            return self.fallback.translate(key)
+        self.store(key, result)
+        return result
+
+    def translate_batch(self, texts, max_workers=4):
+        # Misses are translated concurrently; results come back in input order
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(self.translate, texts))
@@ -1,41 +1,112 @@
 import streamlit as st
-import json
+import threading
 from datetime import datetime, timedelta
 
-class UserStorage:
-    def __init__(self):
-        if 'user_data' not in st.session_state:
-            st.session_state.user_data = {}
+from locked_json import locked_json
+from sqlite_store import SQLiteStore
+from user_directory import UserDirectory, DEFAULT_QUOTA
 
-    def load_data(self):
-        return st.session_state.user_data
+IMAGE_LIMIT = DEFAULT_QUOTA  # Limit to 3 images per user
 
-    def save_data(self):
-        # No need to save, as we're using session state
-        pass
 
-    def get_user_data(self, username):
-        data = self.load_data()
-        if username not in data:
-            data[username] = {"image_count": 0, "last_email_sent": None}
-        return data[username]
+class SQLiteBackend(SQLiteStore):
+    # Default backend: one WAL-mode database file shared by every process on the host
+    def __init__(self, path="user_data.db"):
+        super().__init__(path)
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " username TEXT PRIMARY KEY,"
+                " image_count INTEGER NOT NULL DEFAULT 0,"
+                " last_email_sent TEXT)"
+            )
 
-    def increment_image_count(self, username):
-        user_data = self.get_user_data(username)
-        user_data["image_count"] += 1
-        self.save_data()
+    def get(self, username):
+        row = self._connect().execute(
+            "SELECT image_count, last_email_sent FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        if row is None:
+            return {"image_count": 0, "last_email_sent": None}
+        return {"image_count": row[0], "last_email_sent": row[1]}
 
-    def set_last_email_sent(self, username):
-        user_data = self.get_user_data(username)
-        user_data["last_email_sent"] = datetime.now().isoformat()
-        self.save_data()
+    def try_increment(self, username, limit):
+        with self.connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+            cursor = conn.execute(
+                "UPDATE users SET image_count = image_count + 1 WHERE username = ? AND (? IS NULL OR image_count < ?)",
+                (username, limit, limit),
+            )
+            return cursor.rowcount == 1
 
-    def can_generate_image(self, username):
-        user_data = self.get_user_data(username)
-        # if user is "דודזלצר" or "אורןפונו" or "דבורהאייפרמן" or "שירייכנר"
-        if username == "דודזלצר" or username == "אורןפונו" or username == "דבורהאייפרמן" or username == "שירייכנר":
+    def add(self, username, delta):
+        with self.connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+            conn.execute("UPDATE users SET image_count = MAX(image_count + ?, 0) WHERE username = ?", (delta, username))
+
+    def set_last_email_sent(self, username, timestamp):
+        with self.connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+            conn.execute("UPDATE users SET last_email_sent = ? WHERE username = ?", (timestamp, username))
+
+
+class JSONFileBackend:
+    # Single JSON file guarded by an flock, for setups where SQLite isn't an option
+    def __init__(self, path="user_data.json"):
+        self.path = path
+        self.thread_lock = threading.Lock()
+
+    @staticmethod
+    def _user(data, username):
+        return data.setdefault(username, {"image_count": 0, "last_email_sent": None})
+
+    def get(self, username):
+        with locked_json(self.path, self.thread_lock) as data:
+            return dict(data.get(username, {"image_count": 0, "last_email_sent": None}))
+
+    def try_increment(self, username, limit):
+        with locked_json(self.path, self.thread_lock) as data:
+            user_data = self._user(data, username)
+            if limit is not None and user_data["image_count"] >= limit:
+                return False
+            user_data["image_count"] += 1
             return True
-        return user_data["image_count"] < 3 # Limit to 3 images per user
+
+    def add(self, username, delta):
+        with locked_json(self.path, self.thread_lock) as data:
+            user_data = self._user(data, username)
+            user_data["image_count"] = max(user_data["image_count"] + delta, 0)
+
+    def set_last_email_sent(self, username, timestamp):
+        with locked_json(self.path, self.thread_lock) as data:
+            self._user(data, username)["last_email_sent"] = timestamp
+
+
+BACKENDS = {"sqlite": SQLiteBackend, "json": JSONFileBackend}
+
+
+class UserStorage:
+    def __init__(self, backend, directory=None):
+        self.backend = backend
+        # Per-user quotas (and unlimited users) come from the user directory
+        self.directory = directory
+
+    def get_user_data(self, username):
+        return self.backend.get(username)
+
+    def image_limit(self, username):
+        if self.directory is None:
+            return IMAGE_LIMIT
+        return self.directory.quota(username)
+
+    def try_consume_image(self, username):
+        # Atomic check-and-increment, so a refresh or a second tab can't slip past the quota
+        return self.backend.try_increment(username, self.image_limit(username))
+
+    def refund_image(self, username):
+        self.backend.add(username, -1)
+
+    def set_last_email_sent(self, username):
+        self.backend.set_last_email_sent(username, datetime.now().isoformat())
 
     def can_send_email(self, username):
         user_data = self.get_user_data(username)
@@ -44,4 +115,16 @@ class UserStorage:
         last_sent = datetime.fromisoformat(user_data["last_email_sent"])
         return datetime.now() - last_sent > timedelta(minutes=5)
 
-user_storage = UserStorage()
\ No newline at end of file
+
+def create_backend(kind="sqlite", path=None):
+    backend_class = BACKENDS[kind]
+    return backend_class(path) if path else backend_class()
+
+
+# The one directory per process: the app and worker.py hand it to generation_pipeline.configure
+user_directory = UserDirectory.from_settings(st.secrets, default_quota=IMAGE_LIMIT)
+
+user_storage = UserStorage(create_backend(
+    st.secrets.get("USER_STORAGE_BACKEND", "sqlite"),
+    st.secrets.get("USER_STORAGE_PATH"),
+), user_directory)
@@ -0,0 +1,112 @@
+import argparse
+import getpass
+import hashlib
+import hmac
+import os
+import unicodedata
+from collections import namedtuple
+
+# Everything the app knows about a guest, built once per process from the
+# settings (.streamlit/secrets.toml) and looked up by normalized username.
+# Passwords in secrets.toml may be plaintext or, better, a hash made with:
+#     python user_directory.py hash
+
+HASH_PREFIX = "pbkdf2_sha256"
+HASH_ITERATIONS = 200_000
+
+# Images per guest, unless USER_QUOTAS or UNLIMITED_USERS say otherwise
+DEFAULT_QUOTA = 3
+
+# password is a hash_password() value or plaintext; quota is None for unlimited
+# users; photo is a filename under images/
+UserProfile = namedtuple("UserProfile", "username password photo quota email_tag")
+
+
+def normalize_username(username):
+    # The same Hebrew name may be typed with or without spaces, or in a different Unicode form
+    return "".join(unicodedata.normalize("NFC", username).split()).casefold()
+
+
+def hash_password(password, iterations=HASH_ITERATIONS, salt=None):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{HASH_PREFIX}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, stored):
+    if not stored.startswith(HASH_PREFIX + "$"):
+        # Plaintext in secrets.toml, compared in constant time
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        candidate = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), int(iterations))
+    except ValueError:
+        # A mistyped hash in secrets.toml locks that guest out rather than the login page
+        return False
+    return hmac.compare_digest(candidate.hex(), digest)
+
+
+class UserDirectory:
+    def __init__(self, profiles, default_quota=None, images_dir="images"):
+        self.profiles = {normalize_username(profile.username): profile for profile in profiles}
+        self.default_quota = default_quota
+        self.images_dir = images_dir
+
+    @classmethod
+    def from_settings(cls, settings, default_quota=DEFAULT_QUOTA, images_dir="images"):
+        credentials = settings.get("credentials", {})
+        passwords = dict(zip(credentials.get("usernames", []), credentials.get("passwords", [])))
+        photos = {normalize_username(name): filename for name, filename in settings.get("user_to_file", {}).items()}
+        quotas = {normalize_username(name): quota for name, quota in settings.get("USER_QUOTAS", {}).items()}
+        tags = {normalize_username(name): tag for name, tag in settings.get("USER_EMAIL_TAGS", {}).items()}
+        # Guest names don't belong in the code: nobody is unlimited unless UNLIMITED_USERS lists them
+        unlimited = {normalize_username(name) for name in settings.get("UNLIMITED_USERS", ())}
+
+        # Guests with a photo but no login still get a profile, so tools like
+        # warm_init_images.py see them; the name in credentials wins otherwise
+        names = {normalize_username(name): name for name in settings.get("user_to_file", {})}
+        names.update({normalize_username(name): name for name in passwords})
+
+        profiles = []
+        for key, name in names.items():
+            password = passwords.get(name)
+            photo = photos.get(key)
+            quota = None if key in unlimited else quotas.get(key, default_quota)
+            email_tag = tags.get(key, os.path.splitext(photo)[0] if photo else "")
+            profiles.append(UserProfile(name, password, photo, quota, email_tag))
+        return cls(profiles, default_quota=default_quota, images_dir=images_dir)
+
+    def get(self, username):
+        return self.profiles.get(normalize_username(username or ""))
+
+    def authenticate(self, username, password):
+        # Returns the matching profile, whose username is the canonical spelling
+        profile = self.get(username)
+        if profile is None or profile.password is None:
+            return None
+        if not verify_password(password, profile.password):
+            return None
+        return profile
+
+    def quota(self, username):
+        profile = self.get(username)
+        return profile.quota if profile is not None else self.default_quota
+
+    def photo_path(self, username):
+        profile = self.get(username)
+        if profile is None or not profile.photo:
+            return None
+        return os.path.join(self.images_dir, profile.photo)
+
+    def email_tag(self, username):
+        profile = self.get(username)
+        return profile.email_tag if profile is not None else ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="User directory tools")
+    parser.add_argument("command", choices=["hash"], help="hash: print a password hash for secrets.toml")
+    parser.add_argument("--iterations", type=int, default=HASH_ITERATIONS)
+    args = parser.parse_args()
+
+    print(hash_password(getpass.getpass("Password: "), iterations=args.iterations))
@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+
+import streamlit as st
+
+import generation_pipeline
+from init_image_cache import InitImageCache, DEFAULT_TTL
+from leonardo_client import LeonardoClient, LEONARDO_API_BASE
+from photo_store import PhotoStore
+
+# Pre-uploads every guest photo listed in user_to_file before the event starts,
+# so generations hit the init image cache instead of uploading on the critical path.
+# Run from the app directory so st.secrets picks up .streamlit/secrets.toml:
+#     python warm_init_images.py
+
+
+async def warm(client, cache, photo_store, directory, concurrency, force):
+    semaphore = asyncio.Semaphore(concurrency)
+    # Keyed by the canonical username the app uses, however user_to_file spells it
+    user_to_file = {profile.username: profile.photo for profile in directory.profiles.values() if profile.photo}
+
+    async def warm_user(username, filename):
+        try:
+            photo_bytes = await asyncio.to_thread(photo_store.reference_bytes, filename)
+        except FileNotFoundError:
+            print(f"missing   {username}: {photo_store.source_path(filename)}")
+            return
+        if not force and cache.get(username, photo_bytes):
+            print(f"cached    {username}")
+            return
+        async with semaphore:
+            try:
+                image_id = await client.upload_init_image(photo_bytes)
+            except Exception as e:
+                print(f"failed    {username}: {e}")
+                return
+        cache.set(username, photo_bytes, image_id)
+        print(f"uploaded  {username}: {image_id}")
+
+    await asyncio.gather(*(warm_user(u, f) for u, f in user_to_file.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-upload guest photos to Leonardo")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="re-upload even if a cached id is still valid")
+    args = parser.parse_args()
+
+    # Shares the app's rate limit buckets, so warming up during the event doesn't starve guests
+    generation_pipeline.configure(st.secrets)
+    client = LeonardoClient(st.secrets["LEONARDO_API_KEY"], base_url=st.secrets.get("LEONARDO_API_URL", LEONARDO_API_BASE),
+                            rate_limiter=generation_pipeline.get_rate_limiter())
+    cache = InitImageCache(st.secrets.get("INIT_IMAGE_CACHE_PATH", "init_image_cache.json"),
+                           ttl=st.secrets.get("INIT_IMAGE_TTL", DEFAULT_TTL))
+    asyncio.run(warm(client, cache, PhotoStore(), generation_pipeline.get_user_directory(), args.concurrency, args.force))
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+
+import streamlit as st
+
+import generation_pipeline
+from generation_jobs import SQLiteJobQueue
+from metrics import MetricsServer, stage_metrics
+
+logger = logging.getLogger(__name__)
+
+# Runs the generation jobs the app submits when GENERATION_WORKER = "external",
+# so generations don't compete with the UI process and workers scale separately.
+# Jobs left running by a worker that died are picked up again and resume
+# polling their Leonardo generations.
+# Run from the app directory so st.secrets picks up .streamlit/secrets.toml:
+#     python worker.py --processes 2 --concurrency 4
+
+
+def run_job(queue, job, payload):
+    from user_data_storage import user_storage
+
+    username = job.username
+    try:
+        # A cache hit isn't a new generation, so it doesn't use up one of the user's attempts
+        result = asyncio.run(generation_pipeline.run_generation_job(
+            job, username, payload["complete_text"], strategy=payload.get("strategy"),
+            on_cache_hit=lambda: user_storage.refund_image(username),
+        ))
+        queue.complete(job.id, result)
+    except Exception as e:
+        queue.fail(job.id, f"An error occurred: {str(e)}\n\n{traceback.format_exc()}")
+
+
+def work(queue, name, poll_interval, running, lock, max_backoff=30.0):
+    failures = 0
+    while True:
+        try:
+            claimed = queue.claim(name)
+            if claimed is None:
+                failures = 0
+                time.sleep(poll_interval)
+                continue
+            job = claimed[0]
+            with lock:
+                running.add(job.id)
+            try:
+                run_job(queue, *claimed)
+            finally:
+                with lock:
+                    running.discard(job.id)
+            failures = 0
+        except Exception:
+            # A locked or unreachable queue must not take the worker thread down with it
+            failures += 1
+            logger.exception("Worker %s failed to process a job", name)
+            time.sleep(min(poll_interval * 2 ** failures, max_backoff))
+
+
+def beat(queue, interval, running, lock):
+    # Keeps this process's running jobs from being taken over as stale
+    while True:
+        time.sleep(interval)
+        with lock:
+            job_ids = list(running)
+        try:
+            queue.heartbeat(job_ids)
+        except Exception:
+            logger.exception("Heartbeat for %d running jobs failed", len(job_ids))
+
+
+def start_workers(queue, concurrency, poll_interval=0.5, heartbeat_interval=10):
+    # Runs jobs from the queue on daemon threads in this process; used by
+    # worker.py and by the app itself when GENERATION_WORKER = "inline"
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    running = set()
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=work, args=(queue, f"{prefix}:{i}", poll_interval, running, lock),
+                         name=f"generation-{i}", daemon=True)
+        for i in range(concurrency)
+    ]
+    threads.append(threading.Thread(target=beat, args=(queue, heartbeat_interval, running, lock), daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def serve(concurrency, poll_interval, metrics_port=None, callbacks=False):
+    from user_data_storage import user_directory
+
+    generation_pipeline.configure(st.secrets, callbacks=callbacks, directory=user_directory)
+    queue = SQLiteJobQueue(st.secrets.get("JOB_QUEUE_PATH", "jobs.db"),
+                           max_concurrent=st.secrets.get("GENERATION_MAX_CONCURRENT", 4))
+    if metrics_port:
+        stage_metrics.set_gauge("dream_jobs_in_flight", queue.in_flight)
+        stage_metrics.set_gauge("dream_jobs_queued", queue.queued)
+        MetricsServer(port=metrics_port).start()
+
+    for thread in start_workers(queue, concurrency, poll_interval):
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run generation jobs from the shared job queue")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=st.secrets.get("GENERATION_MAX_CONCURRENT", 4),
+                        help="worker threads per process; GENERATION_MAX_CONCURRENT caps jobs across all of them")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--metrics-port", type=int, help="serve /metrics from the first process on this port")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # The first process also owns the metrics and Leonardo callback ports
+    processes = [
+        multiprocessing.Process(target=serve, args=(args.concurrency, args.poll_interval,
+                                                    args.metrics_port if i == 0 else None, i == 0))
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()